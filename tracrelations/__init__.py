@@ -1,3 +1,5 @@
+from .admin import *
 from .api import *
 from .childtickets import *
+from .query import *
 from .ticket import *
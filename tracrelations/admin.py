@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import codecs
+import csv
+import io
+import json
+import os
+import sys
+
+from trac.admin.api import AdminCommandError, get_dir_list, IAdminCommandProvider
+from trac.core import Component, implements
+from trac.resource import ResourceExistsError
+from trac.util.text import printout
+from trac.util.translation import _
+
+from .api import RelationSystem, ValidationError
+from .model import Relation
+
+try:
+    text_type = unicode
+except NameError:
+    # Python 3
+    text_type = str
+PY2 = text_type is not str
+
+# Columns of exported relations. The relation id isn't exported because the
+# importing environment assigns its own ids.
+EXPORT_COLUMNS = ('realm', 'source', 'dest', 'type')
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# Prefix of the rows in the Trac 'system' table holding the progress of an import
+IMPORT_PROGRESS_PREFIX = 'relation_import:'
+
+
+class RelationAdminCommands(Component):
+    """trac-admin commands for relations."""
+
+    implements(IAdminCommandProvider)
+
+    export_page_size = 5000
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('relation export', '[--realm=<realm>] [--type=<type>] [--format=csv|jsonl] [file]',
+               """Export relations
+
+               The relations are written to the file or to stdout as
+               CSV with a header line or as one JSON object per line.
+               Memory use doesn't depend on the number of relations.
+               """,
+               self._complete_export, self._do_export)
+        yield ('relation import', '<file> [--format=csv|jsonl] [--batch-size=<n>]',
+               """Import relations exported with 'relation export'
+
+               The relations are validated and committed in batches of
+               <n> rows (default 1000). If the import stops because of
+               an invalid relation, run the command again after fixing
+               the file. The import continues after the last committed
+               batch.
+               """,
+               self._complete_import, self._do_import)
+        yield ('relation rebuild-closure', '',
+               """Rebuild the transitive closure table
+
+               The table holds the relation types given by
+               [relations] closure_types. Run this command after
+               changing the option.
+               """,
+               None, self._do_rebuild_closure)
+
+    def _complete_export(self, args):
+        if args and args[-1].startswith('--format='):
+            return ['--format=' + fmt for fmt in EXPORT_FORMATS]
+
+    def _complete_import(self, args):
+        if len(args) == 1:
+            return get_dir_list(args[-1])
+
+    def _do_export(self, *args):
+        options, args = _parse_options(args, ('realm', 'type', 'format'))
+        if len(args) > 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        fmt = _get_format(options, args[0] if args else None)
+        if args and args[0] != '-':
+            with io.open(args[0], 'w', encoding='utf-8', newline='') as out:
+                self.export_relations(out, options.get('realm'), options.get('type'), fmt)
+        else:
+            # Python 2's stdout only takes byte strings
+            out = codecs.getwriter('utf-8')(sys.stdout) if PY2 else sys.stdout
+            self.export_relations(out, options.get('realm'), options.get('type'), fmt)
+
+    def _do_import(self, *args):
+        options, args = _parse_options(args, ('format', 'batch-size'))
+        if len(args) != 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        try:
+            batch_size = int(options.get('batch-size', 1000))
+            if batch_size < 1:
+                raise ValueError
+        except ValueError:
+            raise AdminCommandError(_("Invalid batch size: %(size)s", size=options['batch-size']))
+        path = args[0]
+        fmt = _get_format(options, path)
+        with io.open(path, encoding='utf-8', newline='') as infile:
+            num = self.import_relations(infile, fmt, batch_size, os.path.abspath(path))
+        printout(_("%(num)d relations imported.", num=num))
+
+    def _do_rebuild_closure(self):
+        relsys = RelationSystem(self.env)
+        num_rows = relsys.rebuild_closure()
+        printout(_("Closure table rebuilt for relation types: %(types)s (%(num)d rows)",
+                   types=', '.join(sorted(relsys.get_closure_types())) or _("none"), num=num_rows))
+
+    # Export and import
+
+    def iter_relations(self, realm=None, reltype=None):
+        """Iterate over the relations as tuples (realm, source, dest, type).
+
+        The rows are fetched in pages of export_page_size relations using the
+        primary key, so only one page is held in memory at any time.
+        """
+        sql = "SELECT id, realm, source, dest, type FROM relation WHERE id>%s"
+        args = []
+        if realm:
+            sql += " AND realm=%s"
+            args.append(realm)
+        if reltype:
+            sql += " AND type=%s"
+            args.append(reltype)
+        sql += " ORDER BY id LIMIT %d" % self.export_page_size
+        last_id = 0
+        while True:
+            rows = self.env.db_query(sql, [last_id] + args)
+            for row in rows:
+                yield row[1:]
+            if len(rows) < self.export_page_size:
+                break
+            last_id = rows[-1][0]
+
+    def export_relations(self, out, realm=None, reltype=None, fmt='csv'):
+        """Write relations to a text file object.
+
+        :param out: file object opened for writing text
+        :param realm: only export relations of this realm
+        :param reltype: only export relations of this type
+        :param fmt: 'csv' or 'jsonl'
+        :return the number of exported relations
+        """
+        num = 0
+        if fmt == 'csv':
+            writerow = _csv_row_writer(out)
+            writerow(EXPORT_COLUMNS)
+            for num, row in enumerate(self.iter_relations(realm, reltype), 1):
+                writerow(row)
+        else:
+            for num, row in enumerate(self.iter_relations(realm, reltype), 1):
+                # json.dumps() returns a byte string on Python 2. It's ASCII only.
+                out.write(text_type(json.dumps(dict(zip(EXPORT_COLUMNS, row)), sort_keys=True)) + u'\n')
+        return num
+
+    def import_relations(self, infile, fmt='csv', batch_size=1000, progress_key=None):
+        """Read relations from a text file object and add them.
+
+        :param infile: file object opened for reading text
+        :param fmt: 'csv' or 'jsonl'
+        :param batch_size: number of relations validated and committed at once
+        :param progress_key: the number of committed rows is saved with this key
+                             in the 'system' table. When given again the rows
+                             already committed are skipped. The progress is
+                             removed when the import is complete.
+        :return the number of imported relations
+
+        Each batch is validated with RelationSystem.add_relations(). On error an
+        AdminCommandError is raised and the previous batches stay committed.
+        """
+        relsys = RelationSystem(self.env)
+        progress_name = IMPORT_PROGRESS_PREFIX + progress_key if progress_key else None
+        done = 0
+        if progress_name:
+            for value, in self.env.db_query("SELECT value FROM system WHERE name=%s", (progress_name,)):
+                done = int(value)
+                printout(_("Resuming import after %(num)d rows.", num=done))
+
+        def add_batch(batch, first_row):
+            relations = [Relation(self.env, *row) for row in batch]
+            try:
+                with self.env.db_transaction as db:
+                    relsys.add_relations(relations)
+                    if progress_name:
+                        db("DELETE FROM system WHERE name=%s", (progress_name,))
+                        db("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (progress_name, str(first_row + len(batch) - 1)))
+            except (ValidationError, ResourceExistsError, ValueError) as e:
+                # ValueError is raised for empty fields
+                raise AdminCommandError(_("Rows %(first)d to %(last)d were not imported: %(error)s",
+                                          first=first_row, last=first_row + len(batch) - 1,
+                                          error=e))
+
+        num = 0
+        batch = []
+        first_row = done + 1
+        for row_num, row in enumerate(_read_relations(infile, fmt), 1):
+            if row_num <= done:
+                continue
+            batch.append(row)
+            if len(batch) == batch_size:
+                add_batch(batch, first_row)
+                num += len(batch)
+                first_row += len(batch)
+                batch = []
+        if batch:
+            add_batch(batch, first_row)
+            num += len(batch)
+        if progress_name:
+            self.env.db_transaction("DELETE FROM system WHERE name=%s", (progress_name,))
+        return num
+
+
+def _parse_options(args, names):
+    """Split trac-admin arguments into options of the form '--name=value'
+    and positional arguments.
+    """
+    options = {}
+    positional = []
+    for arg in args:
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            if name not in names or not sep:
+                raise AdminCommandError(_("Invalid option: %(option)s", option=arg), show_usage=True)
+            options[name] = value
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def _get_format(options, path=None):
+    fmt = options.get('format')
+    if not fmt:
+        fmt = 'jsonl' if path and path.endswith(('.jsonl', '.json')) else 'csv'
+    if fmt not in EXPORT_FORMATS:
+        raise AdminCommandError(_("Invalid format: %(format)s", format=fmt), show_usage=True)
+    return fmt
+
+
+def _csv_row_writer(out):
+    """Return a function writing a row as CSV to a text file object.
+
+    The csv module of Python 2 only handles byte strings so the rows are
+    encoded for it and decoded again.
+    """
+    if not PY2:
+        return csv.writer(out, lineterminator='\n').writerow
+    buf = io.BytesIO()
+    writer = csv.writer(buf, lineterminator='\n')
+
+    def writerow(row):
+        writer.writerow([text_type(val).encode('utf-8') for val in row])
+        out.write(buf.getvalue().decode('utf-8'))
+        buf.seek(0)
+        buf.truncate()
+    return writerow
+
+
+def _csv_reader(infile):
+    """Iterate over the CSV rows of a text file object, see _csv_row_writer()."""
+    if not PY2:
+        return csv.reader(infile)
+    return ([cell.decode('utf-8') for cell in row]
+            for row in csv.reader(line.encode('utf-8') for line in infile))
+
+
+def _read_relations(infile, fmt):
+    """Read (realm, source, dest, type) tuples from a file written by
+    RelationAdminCommands.export_relations().
+    """
+    if fmt == 'csv':
+        for line_num, row in enumerate(_csv_reader(infile), 1):
+            if line_num == 1 and tuple(row) == EXPORT_COLUMNS:
+                continue
+            if not row:
+                continue
+            if len(row) != len(EXPORT_COLUMNS):
+                raise AdminCommandError(_("Invalid row in line %(line)d: %(row)s",
+                                          line=line_num, row=','.join(row)))
+            yield tuple(row)
+    else:
+        for line_num, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                values = tuple(item[col] for col in EXPORT_COLUMNS)
+            except (ValueError, KeyError, TypeError):
+                values = None
+            # Ids may be numbers. Anything else, e.g. null, is rejected.
+            if not values or not all(isinstance(val, (text_type, int)) and not isinstance(val, bool)
+                                     for val in values):
+                raise AdminCommandError(_("Invalid row in line %(line)d: %(row)s",
+                                          line=line_num, row=line.strip()))
+            yield tuple(text_type(val) for val in values)
@@ -4,28 +4,80 @@
 #
 # License: 3-clause BSD
 #
+from itertools import product
+from threading import RLock
+
+from trac.cache import cached
+from trac.config import IntOption, ListOption
 from trac.core import Component, ExtensionPoint, implements, Interface, TracError
 from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
 from trac.env import IEnvironmentSetupParticipant
+from trac.resource import ResourceExistsError
 from trac.ticket.admin import AbstractEnumAdminPanel
 from trac.ticket.model import AbstractEnum, simplify_whitespace
 from trac.util.text import to_unicode
 from trac.util.translation import N_
 
-from tracrelations.model import Relation
+from tracrelations.model import chunked, Relation
 
 
 db_version_key = 'relation_version'
-db_version = 1
-
-table = """CREATE TABLE relation (
-    id              serial PRIMARY KEY,
-    realm           text,
-    source          text,
-    dest            text,
-    type            text,
-    UNIQUE(realm, source, dest, type)
-);"""
+db_version = 4
+
+# Version 2 adds covering indexes for lookups by destination (e.g. 'which tickets
+# block #123') and by relation type (e.g. all parent -> child relations).
+table = Table('relation', key='id')[
+    Column('id', auto_increment=True),
+    Column('realm'),
+    Column('source'),
+    Column('dest'),
+    Column('type'),
+    Index(['realm', 'source', 'dest', 'type'], unique=True),
+    Index(['realm', 'dest', 'type', 'source']),
+    Index(['realm', 'type', 'source', 'dest']),
+]
+
+# Version 3 adds the change log used to keep the in-memory relation index of each
+# process up to date. The id is taken from CHANGE_LOG_KEY, see log_changes().
+log_table = Table('relation_log', key='id')[
+    Column('id', type='int64'),
+    Column('action'),
+    Column('realm'),
+    Column('source'),
+    Column('dest'),
+    Column('type'),
+]
+
+# Version 4 adds the optional transitive closure of relation types listed
+# in [relations] closure_types. There is one row for each pair of items
+# where 'descendant' can be reached from 'ancestor'. 'depth' is the length
+# of the shortest path.
+closure_table = Table('relation_closure', key=('realm', 'type', 'ancestor', 'descendant'))[
+    Column('realm'),
+    Column('type'),
+    Column('ancestor'),
+    Column('descendant'),
+    Column('depth', type='int'),
+    Index(['realm', 'type', 'descendant', 'ancestor', 'depth']),
+]
+
+# Row in the Trac 'system' table holding the relation types of the closure table
+CLOSURE_TYPES_KEY = 'relation_closure_types'
+
+# Row in the Trac 'system' table holding the id of the last change log entry.
+# It is created with the change log in version 3. Unlike the 'cache' table the
+# 'system' table isn't flushed so the ids are never used twice.
+CHANGE_LOG_KEY = 'relation_log_id'
+# Number of change log entries kept in the database
+CHANGE_LOG_SIZE = 10000
+# A process reloads its relation index when it is more changes behind
+MAX_INCREMENTAL_CHANGES = 1000
+
+
+# Directions for traversing relations
+FORWARD = 'forward'  # from source to destination
+BACKWARD = 'backward'  # from destination to source
 
 
 class ValidationError(TracError):
@@ -34,12 +86,13 @@ class ValidationError(TracError):
 
 def delete_relations_table(env):
     dbm = DatabaseManager(env)
-    dbm.drop_tables(('relation',))
+    dbm.drop_tables(('relation', 'relation_log', 'relation_closure'))
 
     with env.db_transaction as db:
         db("DELETE FROM system WHERE name='tracrelations_version'")
         db("DELETE FROM system WHERE name='tracrelation_version'")
         db("DELETE FROM system WHERE name='relation_version'")
+        db("DELETE FROM system WHERE name IN (%s, %s)", (CLOSURE_TYPES_KEY, CHANGE_LOG_KEY))
 
 
 class IRelationChangeListener(Interface):
@@ -47,6 +100,13 @@ class IRelationChangeListener(Interface):
     def relation_added(relation):
         """Called when a relation was added"""
 
+    def relations_added(relations):
+        """Called with a list of relations added at once with
+        RelationSystem.add_relations().
+
+        This method is optional. If a listener doesn't implement it
+        relation_added() is called for each relation."""
+
     def relation_deleted(relation):
         """Called when a relation was deleted"""
 
@@ -58,22 +118,283 @@ def check_cycle(env, relation):
     :param relation: a Relation with all necessary data
 
     Note that this function checks for relations of the same type and the same realm.
-    """
-    id_list = [relation['source'], relation['dest']]
 
-    def find_cycle(relation, id_list):
-        # Note that we add '->' and
-        for rel in Relation.select(env, relation['realm'], src=relation['dest'], reltype=relation['type']):
-            if rel['dest'] in id_list:
+    If the relation type is kept in the closure table or the database supports
+    recursive queries the check is done with a single query. Only if a cycle is
+    found the in-memory traversal is done to report the cycle.
+
+    The recursive query and the traversal stop with a ValidationError when more
+    nodes than configured with {{{[relations] max_cycle_check_nodes}}} would have
+    to be visited. The closure table needs a single lookup so there is no limit.
+    """
+    relsys = RelationSystem(env)
+    src = str(relation['source'])
+    dest = str(relation['dest'])
+    budget = relsys.max_cycle_check_nodes
+    if relation['type'] in relsys.get_closure_types():
+        if not relsys._closure_contains(relation['realm'], relation['type'], dest, src):
+            return
+    elif relsys.has_recursive_cte:
+        # One more row than allowed tells us if the limit is exceeded
+        reachable = relsys._reachable_cte_items(relation['realm'], dest, relation['type'], budget + 1)
+        if src not in reachable:
+            if len(reachable) > budget:
+                raise ValidationError("Validation failed. More than %s related items must be checked "
+                                      "for cycles." % budget)
+            return
+
+    graph = RelationGraph(env).get_graph(relation['realm'], relation['type'])
+
+    # The new relation closes a cycle if the source can be reached from the
+    # destination. Each node is expanded only once. For each visited node
+    # we remember the node we came from to be able to report the cycle.
+    parents = {dest: src}
+    stack = [dest]
+    while stack:
+        node = stack.pop()
+        for child in graph.get(node, ()):
+            if child == src:
+                path = [node]
+                while path[-1] != dest:
+                    path.append(parents[path[-1]])
+                path.append(src)
                 # Make pretty error message here
-                msg = ' -> '.join(id_list)
+                msg = ' -> '.join(reversed(path))
                 raise ValidationError("Validation failed. Cycle detected %s -> %s" %
-                                      (msg, rel['dest']))
-            id_list.append(rel['dest'])
-            find_cycle(rel, id_list)
+                                      (msg, src))
+            if child not in parents:
+                if len(parents) >= budget:
+                    raise ValidationError("Validation failed. More than %s related items must be checked "
+                                          "for cycles." % budget)
+                parents[child] = node
+                stack.append(child)
+
+
+def check_cycles(graph, edges):
+    """Check if adding the given edges to a graph causes a cycle.
+
+    :param graph: adjacency index as returned by RelationGraph.get_graph()
+    :param edges: list of (source, destination) tuples to be added
+
+    The check is done with a single topological sort (Kahn's algorithm) of the
+    existing and new edges. A ValidationError with one of the cycles is raised
+    if the sort can't be completed.
+    """
+    successors = {}
+    for src, dests in graph.items():
+        successors[src] = set(dests)
+    for src, dest in edges:
+        successors.setdefault(src, set()).add(dest)
+
+    in_degree = {}
+    for src, dests in successors.items():
+        in_degree.setdefault(src, 0)
+        for dest in dests:
+            in_degree[dest] = in_degree.get(dest, 0) + 1
+
+    ready = [node for node, degree in in_degree.items() if not degree]
+    while ready:
+        for dest in successors.get(ready.pop(), ()):
+            in_degree[dest] -= 1
+            if not in_degree[dest]:
+                ready.append(dest)
+
+    remaining = {node for node, degree in in_degree.items() if degree}
+    if not remaining:
+        return
+
+    # Each remaining node has a predecessor which is remaining, too. Walking
+    # backwards we must end up in a cycle.
+    predecessors = {}
+    for src, dests in successors.items():
+        if src in remaining:
+            for dest in dests:
+                predecessors.setdefault(dest, src)
+    node = next(iter(remaining))
+    path = []
+    while node not in path:
+        path.append(node)
+        node = predecessors[node]
+    path = path[path.index(node):]
+    path.reverse()
+    raise ValidationError("Validation failed. Cycle detected %s -> %s" %
+                          (' -> '.join(path), path[0]))
+
+
+def _closure_depths(graph, start):
+    """Get the items reachable from start with the length of the shortest path.
+
+    :param graph: dict with key: source, val: list of destinations
+    :return a dict with key: item, val: depth. The start item is only part of it
+            if it is part of a cycle.
+    """
+    # Breadth-first search so the first depth found is the shortest
+    depths = {}
+    level = graph.get(start, ())
+    depth = 1
+    while level:
+        next_level = []
+        for node in level:
+            if node not in depths:
+                depths[node] = depth
+                next_level.extend(graph.get(node, ()))
+        level = next_level
+        depth += 1
+    return depths
+
+
+def _last_log_id(db):
+    for log_id, in db("SELECT MAX(id) FROM relation_log"):
+        return log_id or 0
+
+
+def log_changes(env, action, relations):
+    """Add entries for the given relations to the change log.
 
-    find_cycle(relation, id_list)
-    return
+    :param env: Trac Environment
+    :param action: 'add' or 'delete'
+    :param relations: list of Relation objects
+
+    The ids of the entries are consecutive. They are taken from a row of the
+    Trac 'system' table which is locked until the transaction ends. This way
+    concurrent transactions can't commit entries out of order.
+    """
+    if not relations:
+        return
+    with env.db_transaction as db:
+        # Lock the row before reading it
+        db("UPDATE system SET value=value WHERE name=%s", (CHANGE_LOG_KEY,))
+        for value, in db("SELECT value FROM system WHERE name=%s", (CHANGE_LOG_KEY,)):
+            last_id = int(value)
+            break
+        else:
+            last_id = _last_log_id(db)
+            db("INSERT INTO system (name, value) VALUES (%s, %s)", (CHANGE_LOG_KEY, str(last_id)))
+        first_id = last_id + 1
+        last_id += len(relations)
+        db("UPDATE system SET value=%s WHERE name=%s", (str(last_id), CHANGE_LOG_KEY))
+        db.executemany("""INSERT INTO relation_log (id, action, realm, source, dest, type)
+                          VALUES (%s,%s,%s,%s,%s,%s)""",
+                       [(first_id + idx, action, relation['realm'], str(relation['source']),
+                         str(relation['dest']), relation['type'])
+                        for idx, relation in enumerate(relations)])
+        if last_id > CHANGE_LOG_SIZE:
+            db("DELETE FROM relation_log WHERE id<=%s", (last_id - CHANGE_LOG_SIZE,))
+
+
+class RelationGraph(Component):
+    """In-memory adjacency index of all relations.
+
+    There is one graph for each (realm, type) pair. A graph is loaded from
+    the database on first use. Afterwards the changes done by any process
+    are read from the change log and applied edge by edge. The graphs are
+    only reloaded when the process is too far behind.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._graphs = {}
+        self._log_id = None
+
+    def reset(self):
+        """Drop all graphs of this process. They are loaded again on next use."""
+        with self._lock:
+            with self.env.db_query as db:
+                self._log_id = _last_log_id(db)
+            self._graphs = {}
+
+    def _sync(self):
+        """Apply all changes done since the last sync."""
+        if self._log_id is None:
+            self.reset()
+            return
+        # We read the last entry we already know of, too. If it's gone the change
+        # log was truncated and we may have missed some changes.
+        rows = self.env.db_query("""
+            SELECT id, action, realm, source, dest, type FROM relation_log
+            WHERE id>=%s ORDER BY id LIMIT %s
+            """, (self._log_id, MAX_INCREMENTAL_CHANGES + 2))
+        if self._log_id:
+            if not rows or rows[0][0] != self._log_id:
+                self.log.debug("Relation change log truncated. Reloading relations.")
+                self.reset()
+                return
+            rows = rows[1:]
+        if len(rows) > MAX_INCREMENTAL_CHANGES:
+            self.log.debug("Too many relation changes. Reloading relations.")
+            self.reset()
+            return
+
+        # Graphs returned by get_graph() may be iterated by other threads so
+        # they are never modified. The changes are applied to copies of the
+        # graphs and of the changed sets which replace the old ones.
+        changed = {}  # key: graph key, val: copy of the graph
+        copied = set()  # (graph key, node) of the sets already copied
+        last_id = self._log_id
+        for log_id, action, realm, src, dest, reltype in rows:
+            for reverse in (False, True):
+                key = (realm, reltype, reverse)
+                graph = changed.get(key)
+                if graph is None:
+                    if key not in self._graphs:
+                        continue
+                    graph = changed[key] = dict(self._graphs[key])
+                start, end = (dest, src) if reverse else (src, dest)
+                nodes = graph.get(start)
+                # The copied set was dropped if an earlier change removed its last item
+                if (key, start) not in copied or nodes is None:
+                    nodes = set(nodes) if nodes else set()
+                    copied.add((key, start))
+                if action == 'add':
+                    nodes.add(end)
+                else:
+                    nodes.discard(end)
+                if nodes:
+                    graph[start] = nodes
+                else:
+                    graph.pop(start, None)
+            last_id = log_id
+        # The log position only moves on together with the changed graphs
+        self._graphs.update(changed)
+        self._log_id = last_id
+
+    def get_graph(self, realm, reltype, reverse=False):
+        """Get the adjacency index for the given realm and relation type.
+
+        :param realm: the realm of the relations, e.g. 'ticket'
+        :param reltype: the relation type, e.g. 'parentchild'
+        :param reverse: if True the index maps destinations to sources
+        :return a dict with key: source, val: set of destinations. The returned
+                dict must not be modified.
+        """
+        with self._lock:
+            self._sync()
+            try:
+                return self._graphs[(realm, reltype, reverse)]
+            except KeyError:
+                # Changes committed while loading are applied again with the
+                # next sync. This doesn't do any harm.
+                graph = {}
+                for src, dest in self.env.db_query("""
+                        SELECT source, dest FROM relation WHERE realm=%s AND type=%s
+                        """, (realm, reltype)):
+                    if reverse:
+                        src, dest = dest, src
+                    graph.setdefault(src, set()).add(dest)
+                self._graphs[(realm, reltype, reverse)] = graph
+                return graph
+
+    def reachable(self, realm, start, reltype, direction=FORWARD):
+        """Traverse the in-memory index. See RelationSystem.reachable()."""
+        graph = self.get_graph(realm, reltype, reverse=direction == BACKWARD)
+        seen = set()
+        stack = [str(start)]
+        while stack:
+            for node in graph.get(stack.pop(), ()):
+                if node not in seen:
+                    seen.add(node)
+                    stack.append(node)
+        return seen
 
 
 class RelationSystem(Component):
@@ -99,6 +420,22 @@ class RelationSystem(Component):
 
     change_listeners = ExtensionPoint(IRelationChangeListener)
 
+    # (built, configured) closure types last warned about
+    _closure_mismatch = None
+
+    max_cycle_check_nodes = IntOption('relations', 'max_cycle_check_nodes', default=100000,
+                                      doc="Maximum number of related items visited when checking "
+                                          "a new relation for cycles. The relation is rejected if "
+                                          "the limit is exceeded. Relation types kept in the closure "
+                                          "table are checked with a single lookup without any limit.")
+
+    closure_types = ListOption('relations', 'closure_types', default='',
+                               doc="Relation types kept in the transitive closure table, e.g. "
+                                   "{{{parentchild, blocking}}}. The table makes ancestor and descendant "
+                                   "queries and cycle checks a single lookup. Run "
+                                   "{{{trac-admin <env> relation rebuild-closure}}} after changing "
+                                   "this option.")
+
     def add_relation(self, relation):
         """Add a relation to the database after doing some validation.
 
@@ -123,16 +460,435 @@ class RelationSystem(Component):
 
         # We don't check for duplicates. This will fail with ResourceExistsError
         # in case of duplicates.
-        relation.insert()
+        with self.env.db_transaction:
+            relation.insert()
+            log_changes(self.env, 'add', [relation])
+            self._closure_add([relation])
 
         for listener in self.change_listeners:
             listener.relation_added(relation)
 
+    def add_relations(self, relations):
+        """Add a batch of relations to the database after validating all of them.
+
+        :param relations: list of Relation objects filled with the relevant data
+
+        This is much faster than calling add_relation() for each relation. The
+        batch is validated as a whole: no relation may have the same source and
+        destination, there must be no duplicates within the batch or with
+        existing relations and the new relations must not create any cycle.
+        All relations are inserted in a single transaction. The change listeners
+        are notified once with the whole list.
+
+        In case of validation error a ValidationError is raised.
+        If a relation already exist a ResourceExistsError is raised. In both
+        cases no relation is added.
+        """
+        relations = list(relations)
+        if not relations:
+            return
+
+        graph = RelationGraph(self.env)
+        graphs = {}  # key: (realm, type), val: adjacency index
+        new_edges = {}  # key: (realm, type), val: list of (source, dest)
+        seen = set()
+        for rel in relations:
+            rel.check_fields()
+            src, dest = str(rel['source']), str(rel['dest'])
+            if src == dest:
+                raise ValidationError("Validation failed. Source and destination must be different "
+                                      "for relation %s -> %s." % (src, dest))
+            key = (rel['realm'], src, dest, rel['type'])
+            if key in seen:
+                raise ValidationError("Validation failed. Relation %s -> %s (%s) is given more than once." %
+                                      (src, dest, rel['type']))
+            seen.add(key)
+            graph_key = (rel['realm'], rel['type'])
+            if graph_key not in graphs:
+                graphs[graph_key] = graph.get_graph(*graph_key)
+            if dest in graphs[graph_key].get(src, ()):
+                raise ResourceExistsError("Relation '%s', '%s', '%s', '%s' already exists." % key)
+            new_edges.setdefault(graph_key, []).append((src, dest))
+
+        for graph_key, edges in new_edges.items():
+            check_cycles(graphs[graph_key], edges)
+
+        with self.env.db_transaction:
+            Relation.insert_many(self.env, relations)
+            log_changes(self.env, 'add', relations)
+            self._closure_add(relations)
+
+        for listener in self.change_listeners:
+            if hasattr(listener, 'relations_added'):
+                listener.relations_added(relations)
+            else:
+                for relation in relations:
+                    listener.relation_added(relation)
+
     def delete_relation(self, relation):
-        relation.delete()
+        with self.env.db_transaction:
+            relation.delete()
+            log_changes(self.env, 'delete', [relation])
+            self._closure_delete(relation)
         for listener in self.change_listeners:
             listener.relation_deleted(relation)
 
+    def reachable(self, realm, start, reltype, direction=FORWARD):
+        """Get all items which can be reached from start by following relations
+        of the given type.
+
+        :param realm: the realm of the relations, e.g. 'ticket'
+        :param start: id of the item to start with
+        :param reltype: the relation type, e.g. 'parentchild'
+        :param direction: FORWARD to follow relations from source to destination
+                          (e.g. all descendants of a parent), BACKWARD for the
+                          other way round (e.g. all ancestors of a child).
+        :return a set of ids. The start item is only part of it if it is part of
+                a cycle.
+
+        If the relation type is kept in the closure table or the database supports
+        recursive queries the result is retrieved with a single query. Otherwise
+        the in-memory relation index is traversed.
+        """
+        if reltype in self.get_closure_types():
+            start_col, end_col = ('ancestor', 'descendant') if direction == FORWARD else ('descendant', 'ancestor')
+            return {row[0] for row in self.env.db_query("""
+                    SELECT {end} FROM relation_closure WHERE realm=%s AND type=%s AND {start}=%s
+                    """.format(start=start_col, end=end_col), (realm, reltype, str(start)))}
+        if self.has_recursive_cte:
+            return {row[0] for row in self._cte_query(
+                    self._reachable_cte_sql(direction) + "SELECT id FROM reachable",
+                    (realm, reltype, str(start), realm, reltype))}
+        return RelationGraph(self.env).reachable(realm, start, reltype, direction)
+
+    def descendants(self, realm, starts, reltype):
+        """Get the items reachable from each of several items by following
+        relations of the given type from source to destination.
+
+        :param realm: the realm of the relations, e.g. 'ticket'
+        :param starts: list of ids of the items to start with
+        :param reltype: the relation type, e.g. 'parentchild'
+        :return a dict with key: start id as string, val: set of ids. Each
+                start item is part of the dict.
+
+        This is reachable() for many items. The closure table or a single
+        recursive query is used when possible, otherwise the in-memory relation
+        index is traversed.
+        """
+        starts = sorted({str(start) for start in starts})
+        result = {start: set() for start in starts}
+        if reltype in self.get_closure_types():
+            for chunk in chunked(starts, 2):
+                for ancestor, descendant in self.env.db_query("""
+                        SELECT ancestor, descendant FROM relation_closure
+                        WHERE realm=%s AND type=%s AND ancestor IN ({0})
+                        """.format(','.join(['%s'] * len(chunk))), [realm, reltype] + chunk):
+                    result[ancestor].add(descendant)
+        elif self.has_recursive_cte:
+            for chunk in chunked(starts, 4):
+                # Same as _reachable_cte_sql() but each row keeps the item it started with
+                for start, item in self._cte_query("""
+                        WITH RECURSIVE reachable(start, id) AS (
+                            SELECT source, dest FROM relation WHERE realm=%s AND type=%s AND source IN ({0})
+                            UNION
+                            SELECT reachable.start, r.dest FROM relation r, reachable
+                            WHERE r.realm=%s AND r.type=%s AND r.source=reachable.id
+                        )
+                        SELECT start, id FROM reachable
+                        """.format(','.join(['%s'] * len(chunk))), [realm, reltype] + chunk + [realm, reltype]):
+                    result[start].add(item)
+        else:
+            graph = RelationGraph(self.env)
+            for start in starts:
+                result[start] = graph.reachable(realm, start, reltype, FORWARD)
+        return result
+
+    @property
+    def has_recursive_cte(self):
+        """True if the database supports 'WITH RECURSIVE' queries."""
+        scheme = DatabaseManager(self.env).connection_uri.split(':', 1)[0]
+        if scheme == 'postgres':
+            return True
+        if scheme == 'sqlite':
+            from trac.db.sqlite_backend import sqlite_version
+            return sqlite_version >= (3, 8, 3)
+        return False
+
+    @staticmethod
+    def _reachable_cte_sql(direction):
+        start, end = ('source', 'dest') if direction == FORWARD else ('dest', 'source')
+        # UNION (not UNION ALL) drops already visited items so the query
+        # terminates for cycles, too.
+        return """
+            WITH RECURSIVE reachable(id) AS (
+                SELECT {end} FROM relation WHERE realm=%s AND type=%s AND {start}=%s
+                UNION
+                SELECT r.{end} FROM relation r, reachable
+                WHERE r.realm=%s AND r.type=%s AND r.{start}=reachable.id
+            )
+            """.format(start=start, end=end)
+
+    def _reachable_cte_items(self, realm, start, reltype, limit):
+        """Get at most 'limit' items reachable from start as a set."""
+        return {row[0] for row in self._cte_query(
+            self._reachable_cte_sql(FORWARD) + "SELECT id FROM reachable LIMIT %s",
+            (realm, reltype, str(start), realm, reltype, limit))}
+
+    def _cte_query(self, sql, args):
+        # Read-only connections only accept statements starting with 'SELECT'
+        # so we have to use a cursor here.
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+
+    # Transitive closure
+
+    @cached
+    def _built_closure_types(self):
+        """The relation types the closure table was built for by rebuild_closure()."""
+        for value, in self.env.db_query("SELECT value FROM system WHERE name=%s", (CLOSURE_TYPES_KEY,)):
+            return frozenset(reltype for reltype in value.split(',') if reltype)
+        return frozenset()
+
+    def get_closure_types(self):
+        """Get the relation types which may be looked up in the closure table.
+
+        :return a set of relation types
+
+        These are the types given by [relations] closure_types the table was
+        built for. Types which were removed from the option or added without
+        running rebuild_closure() aren't used for lookups. The table itself is
+        only changed by rebuild_closure().
+        """
+        built = self._built_closure_types
+        configured = set(self.closure_types)
+        if built != configured and self._closure_mismatch != (built, configured):
+            self._closure_mismatch = (built, configured)
+            self.log.warning("The relation closure table was built for types '%s' but [relations] "
+                             "closure_types is '%s'. Run 'trac-admin <env> relation rebuild-closure'.",
+                             ', '.join(sorted(built)), ', '.join(sorted(configured)))
+        return built & configured
+
+    def _set_closure_types(self, reltypes):
+        with self.env.db_transaction as db:
+            db("DELETE FROM system WHERE name=%s", (CLOSURE_TYPES_KEY,))
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               (CLOSURE_TYPES_KEY, ','.join(sorted(reltypes))))
+            del self._built_closure_types
+
+    def _lock_closure(self, db):
+        """Lock the row holding the closure types until the transaction ends.
+
+        This serializes concurrent updates of the closure table so each one
+        sees the rows inserted by the others.
+        """
+        db("UPDATE system SET value=value WHERE name=%s", (CLOSURE_TYPES_KEY,))
+
+    def rebuild_closure(self):
+        """Build the closure table from scratch for the types given by
+        [relations] closure_types.
+
+        Rows of types which were removed from the option are deleted.
+
+        :return the number of rows in the closure table
+
+        A ValidationError is raised and the table is left unchanged if the
+        relations of one of the types contain a cycle.
+        """
+        reltypes = sorted(set(self.closure_types))
+        num_rows = 0
+        with self.env.db_transaction as db:
+            self._lock_closure(db)
+            db("DELETE FROM relation_closure")
+            graphs = {}  # key: (realm, type), val: dict with key: source, val: list of destinations
+            for chunk in chunked(reltypes):
+                for realm, src, dest, reltype in db("""
+                        SELECT realm, source, dest, type FROM relation WHERE type IN ({0})
+                        ORDER BY realm, type, source, dest
+                        """.format(','.join(['%s'] * len(chunk))), chunk):
+                    graphs.setdefault((realm, reltype), {}).setdefault(src, []).append(dest)
+            for (realm, reltype), graph in graphs.items():
+                # Relations written by SQL or before the type was checked for
+                # cycles may contain one. The closure can't be maintained then.
+                try:
+                    check_cycles(graph, [])
+                except ValidationError as e:
+                    raise ValidationError("The closure table can't be built for relation type '%s' "
+                                          "of realm '%s'. %s" % (reltype, realm, to_unicode(e)))
+                for ancestor in graph:
+                    depths = _closure_depths(graph, ancestor)
+                    db.executemany("""
+                        INSERT INTO relation_closure (realm, type, ancestor, descendant, depth)
+                        VALUES (%s,%s,%s,%s,%s)""",
+                        [(realm, reltype, ancestor, node, depth) for node, depth in depths.items()])
+                    num_rows += len(depths)
+            self._set_closure_types(reltypes)
+        return num_rows
+
+    def _closure_contains(self, realm, reltype, ancestor, descendant):
+        return bool(self.env.db_query("""
+            SELECT 1 FROM relation_closure
+            WHERE realm=%s AND type=%s AND ancestor=%s AND descendant=%s
+            """, (realm, reltype, ancestor, descendant)))
+
+    def _closure_select(self, db, realm, reltype, column, item):
+        """Get the ancestors ('column' is 'descendant') or descendants ('column'
+        is 'ancestor') of an item as dict with key: item, val: depth.
+        """
+        other = 'ancestor' if column == 'descendant' else 'descendant'
+        return dict(db("""
+            SELECT {other}, depth FROM relation_closure WHERE realm=%s AND type=%s AND {column}=%s
+            """.format(other=other, column=column), (realm, reltype, item)))
+
+    @staticmethod
+    def _closure_pair_chunks(ancestors, descendants):
+        """Split the pairs of ancestors and descendants into chunks small enough
+        for a query with 'ancestor IN (...) AND descendant IN (...)'.
+        """
+        return product(chunked(sorted(ancestors), 2, 2), chunked(sorted(descendants), 2, 2))
+
+    def _closure_add(self, relations):
+        """Add the pairs connected by new relations to the closure table.
+
+        Each ancestor of the source (including the source) now reaches each
+        descendant of the destination (including the destination). Existing
+        pairs get the shorter depth.
+        """
+        # All built types are kept up to date, even if they were removed from
+        # the option, so the table is correct when they are added again.
+        closure_types = self._built_closure_types
+        if not any(relation['type'] in closure_types for relation in relations):
+            return
+        with self.env.db_transaction as db:
+            self._lock_closure(db)
+            for relation in relations:
+                realm, reltype = relation['realm'], relation['type']
+                if reltype not in closure_types:
+                    continue
+                src, dest = str(relation['source']), str(relation['dest'])
+                ancestors = self._closure_select(db, realm, reltype, 'descendant', src)
+                ancestors[src] = 0
+                descendants = self._closure_select(db, realm, reltype, 'ancestor', dest)
+                descendants[dest] = 0
+
+                existing = {}
+                for anc_chunk, desc_chunk in self._closure_pair_chunks(ancestors, descendants):
+                    for ancestor, descendant, depth in db("""
+                            SELECT ancestor, descendant, depth FROM relation_closure
+                            WHERE realm=%s AND type=%s AND ancestor IN ({0}) AND descendant IN ({1})
+                            """.format(','.join(['%s'] * len(anc_chunk)), ','.join(['%s'] * len(desc_chunk))),
+                            [realm, reltype] + anc_chunk + desc_chunk):
+                        existing[(ancestor, descendant)] = depth
+
+                new_rows = []
+                shorter = []
+                for ancestor, anc_depth in ancestors.items():
+                    for descendant, desc_depth in descendants.items():
+                        depth = anc_depth + desc_depth + 1
+                        old_depth = existing.get((ancestor, descendant))
+                        if old_depth is None:
+                            new_rows.append((realm, reltype, ancestor, descendant, depth))
+                        elif depth < old_depth:
+                            shorter.append((depth, realm, reltype, ancestor, descendant))
+                if new_rows:
+                    db.executemany("""
+                        INSERT INTO relation_closure (realm, type, ancestor, descendant, depth)
+                        VALUES (%s,%s,%s,%s,%s)""", new_rows)
+                if shorter:
+                    db.executemany("""
+                        UPDATE relation_closure SET depth=%s
+                        WHERE realm=%s AND type=%s AND ancestor=%s AND descendant=%s""", shorter)
+
+    def _closure_delete(self, relation):
+        """Update the closure table after a relation was deleted.
+
+        Only pairs of an ancestor of the source (including the source) and a
+        descendant of the destination (including the destination) may be
+        affected. The descendants of these ancestors are computed again from
+        the remaining relations and the closure rows of unaffected items. If the
+        relations contain a cycle the descendants of the ancestors are computed
+        from all relations of the type instead.
+        """
+        realm, reltype = relation['realm'], relation['type']
+        if reltype not in self._built_closure_types:
+            return
+        src, dest = str(relation['source']), str(relation['dest'])
+        with self.env.db_transaction as db:
+            self._lock_closure(db)
+            ancestors = set(self._closure_select(db, realm, reltype, 'descendant', src))
+            ancestors.add(src)
+            descendants = set(self._closure_select(db, realm, reltype, 'ancestor', dest))
+            descendants.add(dest)
+
+            def children(item):
+                return [row[0] for row in db("""
+                    SELECT dest FROM relation WHERE realm=%s AND type=%s AND source=%s
+                    """, (realm, reltype, item))]
+
+            # Compute the new descendants of the ancestors, children first. Items
+            # being expanded are kept in 'visiting'. Reaching one of them again
+            # means the relations contain a cycle, e.g. when they were written
+            # by SQL after the closure table was built.
+            new_depths = {}  # key: ancestor, val: dict with key: descendant, val: depth
+            visiting = set()
+            stack = [(item, None) for item in ancestors]
+            while stack:
+                item, item_children = stack.pop()
+                if item in new_depths:
+                    continue
+                if item_children is None:
+                    if item in visiting:
+                        self.log.warning("Cycle of relation type '%s' in realm '%s' found while updating "
+                                         "the closure table.", reltype, realm)
+                        new_depths = self._closure_recompute(db, realm, reltype, ancestors)
+                        break
+                    visiting.add(item)
+                    item_children = children(item)
+                    pending = [child for child in item_children
+                               if child in ancestors and child not in new_depths]
+                    if pending:
+                        stack.append((item, item_children))
+                        stack.extend((child, None) for child in pending)
+                        continue
+                depths = {}
+                for child in item_children:
+                    depths[child] = 1
+                    if child in ancestors:
+                        child_depths = new_depths[child]
+                    else:
+                        child_depths = self._closure_select(db, realm, reltype, 'ancestor', child)
+                    for descendant, depth in child_depths.items():
+                        if depth + 1 < depths.get(descendant, depth + 2):
+                            depths[descendant] = depth + 1
+                new_depths[item] = depths
+
+            for anc_chunk, desc_chunk in self._closure_pair_chunks(ancestors, descendants):
+                db("""
+                    DELETE FROM relation_closure
+                    WHERE realm=%s AND type=%s AND ancestor IN ({0}) AND descendant IN ({1})
+                    """.format(','.join(['%s'] * len(anc_chunk)), ','.join(['%s'] * len(desc_chunk))),
+                    [realm, reltype] + anc_chunk + desc_chunk)
+            rows = [(realm, reltype, ancestor, descendant, depth)
+                    for ancestor in ancestors
+                    for descendant, depth in new_depths[ancestor].items() if descendant in descendants]
+            if rows:
+                db.executemany("""
+                    INSERT INTO relation_closure (realm, type, ancestor, descendant, depth)
+                    VALUES (%s,%s,%s,%s,%s)""", rows)
+
+    def _closure_recompute(self, db, realm, reltype, ancestors):
+        """Compute the descendants of the given items from all relations of the type.
+
+        :return a dict with key: ancestor, val: dict with key: descendant, val: depth
+        """
+        graph = {}
+        for src, dest in db("""
+                SELECT source, dest FROM relation WHERE realm=%s AND type=%s
+                """, (realm, reltype)):
+            graph.setdefault(src, []).append(dest)
+        return {ancestor: _closure_depths(graph, ancestor) for ancestor in ancestors}
+
     # IEnvironmentSetupParticipant methods
 
     def environment_created(self):
@@ -173,13 +929,28 @@ class RelationSystem(Component):
                       in Trac 1.3.1. A database connection should instead be
                       obtained using a context manager.
         """
-        self.log.info("Installing TracRelations database schema")
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            cursor.execute(table)
-
         dbm = DatabaseManager(self.env)
+        db_installed_version = dbm.get_database_version(db_version_key)
 
-        #dbm.create_tables([table])
-        db_installed_version = 1
-        dbm.set_database_version(db_installed_version, db_version_key)
+        with self.env.db_transaction:
+            if not db_installed_version:
+                self.log.info("Installing TracRelations database schema")
+                dbm.create_tables([table, log_table, closure_table])
+                self.env.db_transaction("INSERT INTO system (name, value) VALUES (%s, '0')",
+                                        (CHANGE_LOG_KEY,))
+            else:
+                if db_installed_version < 2:
+                    # Rebuild the table to add the new indexes. This also fixes
+                    # the 'id' column of version 1 tables on SQLite which didn't
+                    # get any value because the column type was 'serial'.
+                    self.log.info("Upgrading TracRelations database schema to version 2")
+                    dbm.upgrade_tables([table])
+                if db_installed_version < 3:
+                    self.log.info("Upgrading TracRelations database schema to version 3")
+                    dbm.create_tables([log_table])
+                    self.env.db_transaction("INSERT INTO system (name, value) VALUES (%s, '0')",
+                                            (CHANGE_LOG_KEY,))
+                if db_installed_version < 4:
+                    self.log.info("Upgrading TracRelations database schema to version 4")
+                    dbm.create_tables([closure_table])
+            dbm.set_database_version(db_version, db_version_key)
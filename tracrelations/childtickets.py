@@ -8,29 +8,44 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 #
+import re
+from bisect import bisect_right
+from collections import namedtuple
 from pkg_resources import resource_filename
 from trac.admin import IAdminPanelProvider
 from trac.cache import cached
-from trac.config import IntOption
+from trac.config import IntOption, ListOption
 from trac.core import *
 from trac.ticket.api import ITicketChangeListener, TicketSystem
-from trac.ticket.model import Ticket, Type
+from trac.ticket.model import Type
+from trac.util.datefmt import from_utimestamp
 from trac.util.html import tag
-from trac.util.text import exception_to_unicode, to_unicode
-from trac.util.translation import _
-from trac.web.api import IRequestFilter
+from trac.util.text import empty, exception_to_unicode, to_unicode
+from trac.util.translation import _, ngettext
+from trac.web.api import IRequestFilter, IRequestHandler
 from trac.web.chrome import ITemplateProvider
-from trac.web.chrome import add_notice, add_script, add_script_data, add_stylesheet, add_warning, Chrome
+from trac.web.chrome import add_notice, add_script, add_script_data, add_stylesheet, add_warning, Chrome,\
+    web_context
 from trac.wiki.formatter import format_to_html, format_to_oneliner
 
-from tracrelations.api import IRelationChangeListener, RelationSystem
+from tracrelations.api import IRelationChangeListener, RelationGraph, RelationSystem
 from tracrelations.jtransform import JTransformer
-from tracrelations.model import Relation
+from tracrelations.model import chunked, Relation
 from tracrelations.ticket import TktRelation
+from tracrelations.util import get_counter, increment_counter, LRUCache, permission_fingerprint
 
 
 INDENT_PERCENT = 3  # the indentation for the child ticket tree items
 
+ParentTypeSettings = namedtuple('ParentTypeSettings',
+                                ('name', 'allow_child_tickets', 'table_headers', 'restrict_to_child_types',
+                                 'inherited_fields', 'default_child_type'))
+ConfigSnapshot = namedtuple('ConfigSnapshot', ('key', 'parent_types', 'tree_fields'))
+Rollup = namedtuple('Rollup', ('total', 'closed', 'sums'))
+
+# Row in the Trac 'system' table counting the changes of the rollups
+ROLLUP_COUNTER_KEY = 'relation_rollup_generation'
+
 
 def _save_config(config, req, log):
     """Try to save the config, and display either a success notice or a
@@ -204,14 +219,96 @@ class ChildTicketRelations(Component):
     more information.
     """
 
-    implements(IRelationChangeListener, IRequestFilter, ITemplateProvider, ITicketChangeListener)
+    implements(IRelationChangeListener, IRequestFilter, IRequestHandler, ITemplateProvider, ITicketChangeListener)
 
     max_view_depth = IntOption('relations-child', 'max_view_depth', default=3,
                                doc="Maximum depth of child ticket tree shown on the ticket page.")
 
+    max_children_per_level = IntOption('relations-child', 'max_children_per_level', default=100,
+                                       doc="Maximum number of children of a ticket shown at once in the child "
+                                           "ticket tree. More children may be loaded with a link. Set to 0 "
+                                           "to show all children.")
+
+    description_cache_size = IntOption('relations-child', 'description_cache_size', default=1000,
+                                       doc="Number of rendered ticket descriptions of the child ticket tree "
+                                           "kept in memory by each process. Set to 0 to disable the cache.")
+
+    rollup_fields = ListOption('relations-child', 'rollup_fields', default='',
+                               doc="Numeric custom ticket fields summed up over all descendants of a "
+                                   "ticket, e.g. estimates or hours. The sums are shown with the number "
+                                   "of closed child tickets.")
+
+    rollup_cache_size = IntOption('relations-child', 'rollup_cache_size', default=1000,
+                                  doc="Number of ticket rollups kept in memory by each process. Set to 0 "
+                                      "to disable the cache.")
+
+    def __init__(self):
+        self.description_cache = LRUCache(self.description_cache_size)
+        self.rollup_cache = LRUCache(self.rollup_cache_size)
+        self._config_snapshot = None
+
+    @cached
+    def rollup_generation(self):
+        """Generation of the rollups. This changes in all processes when a parent -> child
+        relation is added or deleted or when a child ticket is changed.
+
+        The value is a counter in the 'system' table so it is the same in all
+        processes and is never used twice. See _rollups_changed().
+        """
+        return get_counter(self.env, ROLLUP_COUNTER_KEY)
+
+    def _rollups_changed(self):
+        increment_counter(self.env, ROLLUP_COUNTER_KEY)
+        del self.rollup_generation
+
+    def _config_key(self):
+        """The option values the config snapshot depends on: the [relations-child]
+        section, the custom ticket fields which may be table headers and the
+        default ticket type.
+        """
+        return (tuple(self.config.options('relations-child')), tuple(self.config.options('ticket-custom')),
+                self.config.get('ticket', 'default_type'))
+
+    def _check_config_snapshot(self):
+        """Drop the config snapshot if any of the settings changed. This is
+        done once per request, see pre_process_request().
+        """
+        snapshot = self._config_snapshot
+        if snapshot is not None and snapshot.key != self._config_key():
+            self._config_snapshot = None
+
+    def _get_config_snapshot(self):
+        """Get the snapshot of the [relations-child] settings. It is created
+        on first use after a change of the settings.
+        """
+        snapshot = self._config_snapshot
+        if snapshot is None:
+            key = self._config_key()
+            tree_fields = {'status', 'type', 'description', 'changetime', 'summary', 'owner'}
+            for name, value in key[0]:
+                if name.startswith('parent.') and name.endswith('.table_headers'):
+                    tree_fields.update(self.config.getlist('relations-child', name))
+            snapshot = self._config_snapshot = ConfigSnapshot(key, {}, frozenset(tree_fields))
+        return snapshot
+
+    def get_parent_type(self, name):
+        """Get the child ticket settings for a ticket type.
+
+        :param name: name of the ticket type
+        :return a ParentTypeSettings object
+        """
+        parent_types = self._get_config_snapshot().parent_types
+        try:
+            return parent_types[name]
+        except KeyError:
+            field_names = TicketSystem(self.env).get_ticket_field_labels()
+            settings = parent_types[name] = ParentType(self.config, name, field_names).snapshot()
+            return settings
+
     # IRequestFilter methods
 
     def pre_process_request(self, req, handler):
+        self._check_config_snapshot()
         return handler
 
     def post_process_request(self, req, template, data, content_type):
@@ -248,7 +345,7 @@ class ChildTicketRelations(Component):
 
                 if ticket.exists:
                     xform = JTransformer('div#ticket')
-                    tree = self.create_childticket_tree_html(data, ticket)
+                    tree = self.create_childticket_tree_html(req, ticket)
                     filter_lst.append(xform.after(to_unicode(tree)))
 
                     buttons = self.create_child_ticket_buttons(req, ticket)
@@ -263,14 +360,256 @@ class ChildTicketRelations(Component):
 
         return template, data, content_type
 
-    @cached
-    def childtickets(self):
-        children = {}
-        for rel in Relation.select(self.env, 'ticket', reltype=TktRelation.PARENTCHILD):
-            children.setdefault(int(rel['source']), []).append(int(rel['dest']))
-        return children
+    @property
+    def child_index(self):
+        """The parent -> children index. This is a dict with key: parent id,
+        val: set of child ids. Both are strings.
+
+        The index is kept up to date by the RelationGraph component. Get it
+        once when asking for the children of several tickets.
+        """
+        return RelationGraph(self.env).get_graph('ticket', TktRelation.PARENTCHILD)
+
+    def get_children(self, tkt_id, child_index=None):
+        """Get the ids of the child tickets of the given ticket.
+
+        :param tkt_id: id of the parent ticket
+        :param child_index: the index as returned by the 'child_index' property.
+                            If None the index is fetched.
+        :return a list of ticket ids (int) sorted by id
+        """
+        if child_index is None:
+            child_index = self.child_index
+        return sorted(int(child) for child in child_index.get(str(tkt_id), ()))
+
+    def get_children_page(self, tkt_id, child_index=None, after=0):
+        """Get the next page of child tickets of the given ticket.
+
+        :param tkt_id: id of the parent ticket
+        :param child_index: the index as returned by the 'child_index' property.
+                            If None the index is fetched.
+        :param after: only children with an id greater than this are returned
+        :return tuple (children, remaining) with a list of at most 'max_children_per_level'
+                ticket ids (int) sorted by id and the number of children after this page.
+        """
+        children = self.get_children(tkt_id, child_index)
+        start = bisect_right(children, after)
+        end = start + self.max_children_per_level if self.max_children_per_level > 0 else len(children)
+        return children[start:end], max(0, len(children) - end)
+
+    def load_child_tree(self, tkt_id, child_index=None, indent=1, depth=None, after=0):
+        """Load the tickets of the child ticket tree of the given ticket.
+
+        :param tkt_id: id of the root ticket
+        :param child_index: the index as returned by the 'child_index' property.
+                            If None the index is fetched.
+        :param indent: level in the tree of the children of the root ticket
+        :param depth: number of levels to load. Defaults to all levels up to
+                      'max_view_depth'.
+        :param after: only children of the root ticket with an id greater than
+                      this are loaded
+        :return a list of ChildTicket objects in the order they are shown in
+                the tree. The attribute 'indent' holds the level in the tree.
+                The attribute 'max_view' is True if the ticket has children
+                which were not loaded.
+                When a ticket has more than 'max_children_per_level' children
+                a MoreChildTickets object follows the last loaded child and its
+                descendants.
+
+        The tree is walked breadth-first. For each level the tickets are loaded
+        with one query for the ticket table and one for custom fields. Only
+        the fields needed for the tree are loaded.
+        """
+        if child_index is None:
+            child_index = self.child_index
+        if depth is None:
+            depth = self.max_view_depth - indent + 1
+        last_indent = indent + depth - 1
+        fields = self._get_config_snapshot().tree_fields
+
+        # Pages of children for each parent. Key: parent id, val: (children, remaining)
+        pages = {tkt_id: self.get_children_page(tkt_id, child_index, after)}
+        values = {}
+        level = pages[tkt_id][0]
+        level_indent = indent
+        while level and level_indent <= last_indent:
+            values.update(self._fetch_ticket_values(level, fields))
+            if level_indent < last_indent:
+                for parent in level:
+                    pages[parent] = self.get_children_page(parent, child_index)
+            # A ticket may have several parents so remove duplicates but keep the order
+            level = list(dict.fromkeys(child for parent in level for child in pages.get(parent, ((), 0))[0]
+                                       if child not in values))
+            level_indent += 1
+
+        def add_children(parent_id, indent):
+            children, remaining = pages[parent_id]
+            for child_id in children:
+                if child_id not in values:
+                    continue  # Ticket was deleted
+                # A ticket may have several parents. Each occurrence needs its own object.
+                child = ChildTicket(child_id, values[child_id], indent)
+                child.has_children = str(child_id) in child_index
+                all_tickets.append(child)
+                if indent < last_indent:
+                    add_children(child_id, indent + 1)
+                else:
+                    # Mark that we don't show more children
+                    child.max_view = bool(child_index.get(str(child_id)))
+            if remaining:
+                all_tickets.append(MoreChildTickets(parent_id, children[-1], remaining, indent))
 
-    def create_childticket_tree_html(self, data, ticket):
+        all_tickets = []
+        add_children(tkt_id, indent)
+        return all_tickets
+
+    def _fetch_ticket_values(self, tkt_ids, fields):
+        """Fetch the values of the given fields for several tickets.
+
+        :param tkt_ids: list of ticket ids
+        :param fields: set of field names. Unknown fields are ignored.
+        :return a dict with key: ticket id, val: dict of field values
+        """
+        std_fields = []
+        custom_fields = {}
+        time_fields = set()
+        for field in TicketSystem(self.env).fields:
+            name = field['name']
+            if name not in fields:
+                continue
+            if field['type'] == 'time':
+                time_fields.add(name)
+            if field.get('custom'):
+                custom_fields[name] = field
+            else:
+                std_fields.append(name)
+
+        values = {}
+        for chunk in chunked(tkt_ids, len(custom_fields)):
+            holders = ','.join(['%s'] * len(chunk))
+            with self.env.db_query as db:
+                for row in db("SELECT id, %s FROM ticket WHERE id IN (%s)" %
+                              (','.join(db.quote(name) for name in std_fields), holders), chunk):
+                    tkt_values = values[row[0]] = {}
+                    for name, value in zip(std_fields, row[1:]):
+                        if name in time_fields:
+                            value = from_utimestamp(value)
+                        tkt_values[name] = empty if value is None else value
+                if custom_fields:
+                    for tkt_id, name, value in db("""
+                            SELECT ticket, name, value FROM ticket_custom
+                            WHERE ticket IN (%s) AND name IN (%s)
+                            """ % (holders, ','.join(['%s'] * len(custom_fields))),
+                            chunk + list(custom_fields)):
+                        if tkt_id in values:
+                            if name in time_fields:
+                                # Stored as microsecond timestamp, see trac.ticket.query
+                                try:
+                                    value = from_utimestamp(int(value)) if value else None
+                                except ValueError:
+                                    value = None
+                            values[tkt_id][name] = empty if value is None else value
+
+        # Set defaults for custom fields without a value
+        for tkt_values in values.values():
+            for name, field in custom_fields.items():
+                if name not in tkt_values:
+                    tkt_values[name] = field.get('value', empty)
+        return values
+
+    def get_rollup(self, tkt_id, perm=None):
+        """Get the aggregated data of all descendants of a ticket.
+
+        :param tkt_id: id of the parent ticket
+        :param perm: the PermissionCache of the user. Only descendants the user
+                     has TICKET_VIEW for are taken into account. If None all
+                     descendants are.
+        :return a Rollup object with the number of descendants as 'total', the
+                number of closed descendants as 'closed' and a dict 'sums' with
+                key: field name, val: sum of the field values. The fields are the
+                custom fields given by 'rollup_fields'. Values which aren't numbers
+                are ignored.
+
+        Each descendant is counted once even if reachable by several paths.
+        The values of the descendants are cached until a parent -> child relation
+        or a child ticket changes. See get_rollups().
+        """
+        return self.get_rollups([tkt_id], perm)[tkt_id]
+
+    def get_rollups(self, tkt_ids, perm=None):
+        """Get the rollups of several tickets.
+
+        :param tkt_ids: list of ticket ids
+        :param perm: the PermissionCache of the user, see get_rollup()
+        :return a dict with key: ticket id, val: Rollup object
+
+        The cache holds the values of all descendants of a ticket. The rollup is
+        computed from the values of the descendants visible to the user. Values
+        which aren't cached are retrieved together: the descendants of all tickets
+        with one query and their field values with another one.
+        """
+        generation = self.rollup_generation
+        custom_fields = {field['name']: field for field in TicketSystem(self.env).custom_fields
+                         if field['name'] in self.rollup_fields}
+        descendant_values = {}  # key: ticket id, val: list of (descendant id, field values)
+        missing = []
+        for tkt_id in tkt_ids:
+            cached_values = self.rollup_cache.get((generation, tkt_id))
+            if cached_values is None:
+                missing.append(tkt_id)
+            else:
+                descendant_values[tkt_id] = cached_values
+        if missing:
+            descendants = RelationSystem(self.env).descendants('ticket', missing, TktRelation.PARENTCHILD)
+            values = self._fetch_ticket_values(sorted({int(child) for children in descendants.values()
+                                                       for child in children}),
+                                               {'status'} | set(custom_fields))
+            for tkt_id in missing:
+                cached_values = [(int(child), values[int(child)]) for child in descendants[str(tkt_id)]
+                                 if int(child) in values]
+                self.rollup_cache.set((generation, tkt_id), cached_values)
+                descendant_values[tkt_id] = cached_values
+        return {tkt_id: self._aggregate([tkt_values for child, tkt_values in cached_values
+                                         if perm is None or 'TICKET_VIEW' in perm('ticket', child)],
+                                        custom_fields)
+                for tkt_id, cached_values in descendant_values.items()}
+
+    @staticmethod
+    def _aggregate(values, fields):
+        sums = dict.fromkeys(fields, 0)
+        closed = 0
+        for tkt_values in values:
+            if tkt_values['status'] == 'closed':
+                closed += 1
+            for name in fields:
+                try:
+                    sums[name] += float(tkt_values.get(name))
+                except (TypeError, ValueError):
+                    pass  # Field is empty or no number
+        return Rollup(len(values), closed, sums)
+
+    def render_rollup(self, tkt_id, rollup=None, perm=None):
+        """Render the rollup of a ticket as a span.
+
+        :param rollup: the Rollup of the ticket if already known
+        :param perm: the PermissionCache of the user, see get_rollup()
+        :return a span like '12/40 children closed (30%), Estimate: 20' or None if
+                the ticket has no children
+        """
+        if rollup is None:
+            rollup = self.get_rollup(tkt_id, perm)
+        if not rollup.total:
+            return None
+        text = _("%(closed)s/%(total)s children closed (%(percent)s%%)",
+                 closed=rollup.closed, total=rollup.total, percent=rollup.closed * 100 // rollup.total)
+        if rollup.sums:
+            field_names = TicketSystem(self.env).get_ticket_field_labels()
+            for name in sorted(rollup.sums):
+                value = rollup.sums[name]
+                text += u", %s: %s" % (field_names.get(name, name), int(value) if value == int(value) else value)
+        return tag.span(text, class_="childrel-rollup")
+
+    def create_childticket_tree_html(self, req, ticket):
 
         # Modify ticket.html with sub-ticket table, create button, etc...
         # As follows:
@@ -280,129 +619,159 @@ class ChildTicketRelations(Component):
         #   print list of tickets but do not allow any tickets to be created.
         # - If child tickets are allowed then print list of child tickets or 'No Child Tickets' if none are
         #   currently assigned.
+        #
+        # Only the number of child tickets is part of the page. The tree is loaded level by level
+        # from '/ticket/<id>/children' when the user unfolds the section.
         if ticket and ticket.exists:
-            def indented_table(tkt, treecolumns, indent=0):
-                """Create a table from the ticket tkt which may be indented.
-
-                :param tkt:            a Trac ticket
-                :param treecolumns:    list of column names
-                :param indent:         level of indentation for this table. Int value starting with 0.
-
-                The table has a header holding the items described by treecolums. Next row
-                are the data items matching the header. The following row spans all columns
-                and holds the ticket description.
-                If the description contains wiki data it will be porperly parsed and inserted
-                into the result.
-                For each level of indentation (0, 1, 2, ...) the table will be indented by a
-                percentage defined as INDENT_PERCENT (usually 3..5%).
-                """
-                # Admin may have removed a custom field still in the list of table headers
-                treecolumns = [col for col in treecolumns if col in field_names]
-                desc = format_to_html(self.env, data['context'], tkt['description'])
-
-                if tkt['status'] == 'closed':
-                    cls = "listing childrel-table closed"
-                else:
-                    cls = "listing childrel-table"
-
-                # Return the table
-                return tag.table(
-                    tag.thead(
-                        tag.tr(tag.th("Ticket", class_="id"),
-                               [tag.th(field_names[col], class_=col) for col in treecolumns]
-                               )
-                    ),
-                    tag.tbody(self._table_row(data, tkt, treecolumns, field_format),
-                              tag.tr(
-                                  tag.td(desc, class_="description", colspan="%s" % str(1 + len(treecolumns))),
-                                  class_="even",
-                              ),
-                              tag.tr(
-                                  tag.td(_("(Rest of the child ticket tree is hidden)"),
-                                         class_="system-message notice", colspan="%s" % str(1 + len(treecolumns))),
-                                  class_="even",
-                              ) if tkt.max_view else None,
-                              ),
-                    class_=cls,
-                    style="margin-left: %s%%; width : %s%%" % (str(indent * INDENT_PERCENT),
-                                                               str(100 - indent * INDENT_PERCENT)),
-                )
-
-            def create_table_tree(tickets):
-                """
-                    Create a tree of ticket tables from the tickets in the list tickets.
-                """
-                childtree = []
-                for tkt in tickets:
-                    if tkt.indent == 1:
-                        div = tag.div(class_="childrel-tables")  #  note the trailing s in the class
-                        childtree.append(div)
-
-                    treecolumns = self.config.getlist('relations-child', 'parent.%s.table_headers' % tkt['type'],
-                                                      default=['summary', 'owner'])
-                    # The description will always be displayed in separate td no matter whats defined in the ini
-                    if 'description' in treecolumns:
-                        treecolumns.remove('description')
-
-                    div.append(indented_table(tkt, treecolumns, tkt.indent - 1))
-                return childtree
-
-            def indent_children(tkt, all_tickets, indent=0):
-                tkt.max_view = False
-                if tkt.id in self.childtickets:
-                    indent += 1
-                    for child in self.childtickets[tkt.id]:
-                        if indent > self.max_view_depth:
-                            tkt.max_view = True  # Mark that we don't want to show more children
-                            return
-                        child = Ticket(self.env, child)
-                        child.indent = indent
-                        all_tickets.append(child)
-                        indent_children(child, all_tickets, indent)
-
             # Are child tickets allowed?
-            childtickets_allowed = self.config.getbool('relations-child', 'parent.%s.allow_child_tickets' % ticket['type'])
+            childtickets_allowed = self.get_parent_type(ticket['type']).allow_child_tickets
 
             # Are there any child tickets to display?
-            childtickets = [Ticket(self.env, n) for n in self.childtickets.get(ticket.id, [])]
-            # (tempish) fix for #8612 : force sorting by ticket id
-            childtickets = sorted(childtickets, key=lambda t: t.id)
+            num_children = len(self.child_index.get(str(ticket.id), ()))
 
             # If there are no childtickets and the ticket should not
             # have any child tickets, we can simply drop out here.
-            if not childtickets_allowed and not childtickets:
+            if not childtickets_allowed and not num_children:
                 return ''
 
-            field_names = TicketSystem(self.env).get_ticket_field_labels()
-            # We need this to decide if we should wikify a field in the child table
-            field_format = {item['name']: item.get('format', None) for item in TicketSystem(self.env).get_ticket_fields()}
             # The additional section on the ticket is built up of (potentially) three parts: header, ticket table, buttons. These
             # are all 'wrapped up' in a 'div' with the 'attachments' id (we'll just pinch this to make look and feel consistent with any
             # future changes!)
             snippet = tag.div(id="ct-children", class_="collapsed")  # foldable child tickets area
-
-            # Our 'main' display consists of divs.
-            # buttonform = tag.div()
-            treediv = tag.div()  # This is for displaying the child ticket tree
-
-            # Test if the ticket has children: If so, then list in pretty table.
-            if childtickets:
-                all_tickets = []  # We need this var for the recursive _indent_children() collecting the tickets
-                indent_children(ticket, all_tickets)
-                # This is a list of whole trees of child->grandchild->etc
-                # for each child ticket
-                treediv = create_table_tree(all_tickets)
-
             snippet.append(tag.h3("Child Ticket Tree ",
-                                  tag.span('(%s)' % len(childtickets), class_="trac-count"),
+                                  tag.span('(%s)' % num_children, class_="trac-count"),
                                   class_="foldable"))
-            if childtickets:
-                snippet.append(tag.div(treediv, id="childrelations"))
+            if num_children:
+                snippet.append(self.render_rollup(ticket.id, perm=req.perm))
+                snippet.append(tag.div(id="childrelations",
+                                       **{'data-href': req.href.ticket(ticket.id, 'children')}))
 
             return snippet
         else:
             return ''
 
+    def create_table_tree(self, data, tickets):
+        """Create a tree of ticket tables from the tickets in the list tickets.
+
+        :param data: dict holding the rendering context as 'context'
+        :param tickets: list of ChildTicket objects as returned by load_child_tree()
+        :return list of divs. Each div holds the tables of a child and its descendants.
+        """
+        field_names = TicketSystem(self.env).get_ticket_field_labels()
+        # We need this to decide if we should wikify a field in the child table
+        field_format = {item['name']: item.get('format', None) for item in TicketSystem(self.env).get_ticket_fields()}
+        rollups = self.get_rollups([tkt.id for tkt in tickets
+                                    if isinstance(tkt, ChildTicket) and tkt.has_children],
+                                   data['context'].req.perm)
+        childtree = []
+        top_indent = min(tkt.indent for tkt in tickets) if tickets else 1
+        perm_fingerprint = permission_fingerprint(self.env, data['context'].req.authname)
+        div = None  # holds the tables of the current top level ticket and its descendants
+        for tkt in tickets:
+            if isinstance(tkt, MoreChildTickets):
+                href = data['context'].req.href.ticket(tkt.parent_id, 'children', indent=tkt.indent,
+                                                       after=tkt.after)
+                more = tag.div(tag.a(ngettext("Show %(num)s more child ticket",
+                                              "Show %(num)s more child tickets", tkt.remaining),
+                                     href=href, class_="childrel-more"),
+                               class_="childrel-tables",
+                               style="margin-left: %s%%" % str((tkt.indent - 1) * INDENT_PERCENT))
+                # The link for the children of a nested ticket belongs to the subtree of the top ticket
+                (div if div is not None and tkt.indent > top_indent else childtree).append(more)
+                continue
+            if div is None or tkt.indent == top_indent:
+                div = tag.div(class_="childrel-tables")  #  note the trailing s in the class
+                childtree.append(div)
+
+            # The description will always be displayed in separate td no matter whats defined in the ini
+            treecolumns = [col for col in self.get_parent_type(tkt['type']).table_headers if col != 'description']
+
+            div.append(self._indented_table(data, tkt, treecolumns, field_names, field_format,
+                                            rollups.get(tkt.id), perm_fingerprint))
+        return childtree
+
+    def _indented_table(self, data, tkt, treecolumns, field_names, field_format, rollup=None,
+                        perm_fingerprint=None):
+        """Create a table from the ticket tkt which may be indented.
+
+        :param tkt:            a ChildTicket
+        :param treecolumns:    list of column names
+        :param rollup:         the Rollup of the ticket if it has children
+        :param perm_fingerprint: fingerprint of the user permissions, see
+                               util.permission_fingerprint()
+
+        The table has a header holding the items described by treecolums. Next row
+        are the data items matching the header. The following row spans all columns
+        and holds the ticket description.
+        If the description contains wiki data it will be porperly parsed and inserted
+        into the result.
+        For each level of indentation (1, 2, 3, ...) the table will be indented by a
+        percentage defined as INDENT_PERCENT (usually 3..5%).
+        If the children of the ticket aren't part of the tree a row with a link for
+        loading them is added. When 'max_view_depth' is reached a notice is shown instead.
+        """
+        desc = self._render_description(data['context'], tkt, perm_fingerprint)
+
+        if tkt['status'] == 'closed':
+            cls = "listing childrel-table closed"
+        else:
+            cls = "listing childrel-table"
+
+        colspan = "%s" % str(1 + len(treecolumns))
+        rollup = self.render_rollup(tkt.id, rollup) if tkt.has_children else None
+        if not tkt.max_view:
+            more_row = None
+        elif tkt.indent < self.max_view_depth:
+            href = data['context'].req.href.ticket(tkt.id, 'children', indent=tkt.indent + 1)
+            more_row = tag.tr(tag.td(tag.a(_("Show child tickets"), href=href, class_="childrel-expand"),
+                                     colspan=colspan),
+                              class_="even")
+        else:
+            more_row = tag.tr(tag.td(_("(Rest of the child ticket tree is hidden)"),
+                                     class_="system-message notice", colspan=colspan),
+                              class_="even")
+        indent = tkt.indent - 1
+        # Return the table
+        return tag.table(
+            tag.thead(
+                tag.tr(tag.th("Ticket", class_="id"),
+                       [tag.th(field_names[col], class_=col) for col in treecolumns]
+                       )
+            ),
+            tag.tbody(self._table_row(data, tkt, treecolumns, field_format),
+                      tag.tr(
+                          tag.td(desc, class_="description", colspan=colspan),
+                          class_="even",
+                      ),
+                      tag.tr(tag.td(rollup, colspan=colspan), class_="even") if rollup else None,
+                      more_row,
+                      ),
+            class_=cls,
+            style="margin-left: %s%%; width : %s%%" % (str(indent * INDENT_PERCENT),
+                                                       str(100 - indent * INDENT_PERCENT)),
+        )
+
+    def _render_description(self, context, tkt, perm_fingerprint=None):
+        """Render the description of a ticket in the child ticket tree.
+
+        Rendered descriptions are cached. The key holds the time of the last
+        ticket change so a modified description is rendered again. Wiki
+        rendering depends on the language and the permissions of the user so
+        the user and the fingerprint of the permissions are part of the key.
+        The description is rendered in the context of the child ticket so
+        relative links like 'comment:3' refer to it, no matter which parent
+        shows it.
+        """
+        req = context.req
+        if perm_fingerprint is None:
+            perm_fingerprint = permission_fingerprint(self.env, req.authname)
+        key = (tkt.id, tkt['changetime'], str(req.locale), req.authname, perm_fingerprint)
+        desc = self.description_cache.get(key)
+        if desc is None:
+            desc = format_to_html(self.env, web_context(req, 'ticket', tkt.id), tkt['description'])
+            self.description_cache.set(key, desc)
+        return desc
+
     def _table_row(self, data, ticket, columns, field_format):
         """
         @param data: data dictionary given to the ticket page
@@ -436,8 +805,9 @@ class ChildTicketRelations(Component):
         :return unicode string
         """
 
+        parent_type = self.get_parent_type(ticket['type'])
         # Are child tickets allowed?
-        childtickets_allowed = self.config.getbool('relations-child', 'parent.%s.allow_child_tickets' % ticket['type'])
+        childtickets_allowed = parent_type.allow_child_tickets
 
         button_div = tag.div()
 
@@ -450,19 +820,15 @@ class ChildTicketRelations(Component):
             # Pass extra fields defined in inherit parameter of parent
             inherited_child_fields = [
                 tag.input(type="hidden", name="%s" % field, value=ticket[field]) for field in
-                self.config.getlist('relations-child', 'parent.%s.inherit' % ticket['type'])
+                parent_type.inherited_fields
             ]
 
             # If child types are restricted then create a set of buttons for the allowed types (This will override 'default_child_type).
-            restrict_child_types = self.config.getlist('relations-child',
-                                                       'parent.%s.restrict_child_type' % ticket['type'],
-                                                       default=[])
+            restrict_child_types = parent_type.restrict_to_child_types
 
             if not restrict_child_types:
                 # trac.ini : Default 'type' of child tickets?
-                default_child_type = self.config.get('relations-child',
-                                                     'parent.%s.default_child_type' % ticket['type'],
-                                                     default=self.config.get('ticket', 'default_type'))
+                default_child_type = parent_type.default_child_type
 
                 # ... create a default submit button
                 if ticket['status'] == 'closed':
@@ -502,6 +868,47 @@ class ChildTicketRelations(Component):
                           )
         return to_unicode(button_div)
 
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        """Check if the child tickets of a ticket are requested."""
+        match = re.match(r'/ticket/([0-9]+)/children/*$', req.path_info)
+        if not match:
+            return False
+
+        req.args['id'] = match.group(1)
+        return True
+
+    def process_request(self, req):
+        """Send a HTML fragment with the child ticket tables of a ticket.
+
+        The fragment holds 'depth' levels of the tree (default 1). The argument
+        'indent' is the level of the children in the tree shown on the ticket
+        page. It starts with 1. Only children with an id greater than 'after'
+        are sent.
+        """
+        tkt_id = req.args.getint('id')
+        req.perm('ticket', tkt_id).require('TICKET_VIEW')
+        indent = req.args.getint('indent', 1, min=1, max=self.max_view_depth)
+        depth = req.args.getint('depth', 1, min=1, max=self.max_view_depth - indent + 1)
+        after = req.args.getint('after', 0)
+
+        # Tickets the user may not view are dropped together with their subtrees
+        tickets = []
+        hidden_indent = None
+        for tkt in self.load_child_tree(tkt_id, indent=indent, depth=depth, after=after):
+            if hidden_indent is not None:
+                if tkt.indent > hidden_indent:
+                    continue
+                hidden_indent = None
+            if isinstance(tkt, ChildTicket) and 'TICKET_VIEW' not in req.perm('ticket', tkt.id):
+                hidden_indent = tkt.indent
+                continue
+            tickets.append(tkt)
+        data = {'context': web_context(req, 'ticket', tkt_id)}
+        html = to_unicode(tag(self.create_table_tree(data, tickets))) if tickets else u''
+        req.send(html.encode('utf-8'), 'text/html')
+
     # ITicketChangeListener methods
 
     def ticket_changed(self, ticket, comment, author, old_values):
@@ -510,7 +917,10 @@ class ChildTicketRelations(Component):
         `old_values` is a dictionary containing the previous values of the
         fields that have changed.
         """
-        pass
+        if ('status' in old_values or any(name in old_values for name in self.rollup_fields)) \
+                and str(ticket.id) in RelationGraph(self.env).get_graph('ticket', TktRelation.PARENTCHILD,
+                                                                        reverse=True):
+            self._rollups_changed()
 
     def ticket_created(self, ticket):
         """Called when a ticket is created."""
@@ -521,7 +931,7 @@ class ChildTicketRelations(Component):
             RelationSystem(self.env).add_relation(rel)
 
     def ticket_deleted(self, ticket):
-        pass
+        self._rollups_changed()
 
     def ticket_comment_modified(self, ticket, cdate, author, comment, old_comment):
         """Called when a ticket comment is modified."""
@@ -538,13 +948,18 @@ class ChildTicketRelations(Component):
 
     def relation_added(self, relation):
         """Called when a relation was added"""
-        if relation['type'] == TktRelation.PARENTCHILD:
-            del self.childtickets
+        if relation['realm'] == 'ticket' and relation['type'] == TktRelation.PARENTCHILD:
+            self._rollups_changed()
+
+    def relations_added(self, relations):
+        """Called with a list of relations added at once"""
+        if any(rel['realm'] == 'ticket' and rel['type'] == TktRelation.PARENTCHILD for rel in relations):
+            self._rollups_changed()
 
     def relation_deleted(self, relation):
         """Called when a relation was deleted"""
-        if relation['type'] == TktRelation.PARENTCHILD:
-            del self.childtickets
+        if relation['realm'] == 'ticket' and relation['type'] == TktRelation.PARENTCHILD:
+            self._rollups_changed()
 
     # ITemplateProvider methods
 
@@ -556,6 +971,32 @@ class ChildTicketRelations(Component):
         return [('ticketrelations', resource_filename(__name__, 'htdocs'))]
 
 
+class ChildTicket(object):
+    """A read-only ticket holding only the values needed for the child ticket tree."""
+
+    def __init__(self, tkt_id, values, indent=1):
+        self.id = tkt_id
+        self.values = values
+        self.indent = indent
+        self.max_view = False
+        self.has_children = False
+
+    def __getitem__(self, name):
+        return self.values.get(name)
+
+
+class MoreChildTickets(object):
+    """Placeholder in the child ticket tree for children not loaded because of
+    'max_children_per_level'.
+    """
+
+    def __init__(self, parent_id, after, remaining, indent):
+        self.parent_id = parent_id
+        self.after = after  # id of the last loaded child
+        self.remaining = remaining
+        self.indent = indent
+
+
 class ParentType(object):
     def __init__(self, config, name, field_names):
         """
@@ -597,6 +1038,12 @@ class ParentType(object):
                                default=self.config.get('ticket',
                                                        'default_type'))
 
+    def snapshot(self):
+        """Return the current settings as an immutable ParentTypeSettings object."""
+        return ParentTypeSettings(self.name, self.allow_child_tickets, tuple(self.table_headers),
+                                  tuple(self.restrict_to_child_types), tuple(self.inherited_fields),
+                                  self.default_child_type)
+
     @property
     def table_row_class(self):
         """Return a class (enabled/disabled) for the table row - allows it
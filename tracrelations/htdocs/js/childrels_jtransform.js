@@ -35,8 +35,60 @@ jQuery(document).ready(function($) {
       } // for
   };
 
+  /* Load the first level of the child ticket tree when the section is unfolded.
+     After a failure the tree is loaded again the next time the section is unfolded. */
+  function load_tree(event){
+    var tree = $('#childrelations');
+    if(tree.data('loaded') || tree.data('loading')){
+      return;
+    };
+    tree.data('loading', true);
+    $.get(tree.data('href'), function(html){
+      tree.html(html);
+      tree.data('loaded', true);
+    }).fail(function(){
+      tree.text('Loading the child tickets failed. ');
+    }).always(function(){
+      tree.data('loading', false);
+    });
+  };
+
+  /* Load the children of a ticket in the tree and insert them after the ticket table */
+  function load_children(event){
+    var link = $(this);
+    var row = link.closest('tr');
+    event.preventDefault();
+    row.hide();
+    $.get(link.attr('href'), function(html){
+      link.closest('table').after(html);
+      row.remove();
+    }).fail(function(){
+      row.show();
+    });
+  };
+
+  /* Replace the link with the next page of child tickets */
+  function load_more(event){
+    var link = $(this);
+    var more = link.closest('div.childrel-tables');
+    event.preventDefault();
+    link.hide();
+    $.get(link.attr('href'), function(html){
+      more.replaceWith(html);
+    }).fail(function(){
+      link.show();
+    });
+  };
+
   /* This is from the SmpVersionRoadmap */
   if(typeof childrels_filter !== 'undefined'){
       apply_transform(childrels_filter);
   };
+
+  $('#ct-children > h3.foldable').on('click', load_tree);
+  if($('#ct-children').length && !$('#ct-children').hasClass('collapsed')){
+    load_tree();
+  };
+  $('#childrelations').on('click', 'a.childrel-expand', load_children);
+  $('#childrelations').on('click', 'a.childrel-more', load_more);
 });
@@ -58,6 +58,18 @@ jQuery(document).ready(function($) {
       apply_transform(tktrel_filter);
   };
 
+  /* Relations box is loaded after the page is shown when 'async_box' is enabled */
+  var box = $('#tktrel-box');
+  if(box.length){
+    $.get(box.data('href'), function(html){
+      box.replaceWith(html);
+    }).fail(function(){
+      /* Don't leave the placeholder. Link to the relations page instead. */
+      box.text('Loading the relations failed. ')
+         .append($('<a>').attr('href', box.data('fallback-href')).text('Show relations'));
+    });
+  };
+
   $("#action_resolve_resolve_resolution").on('change', resolution_change);
 
 
@@ -4,9 +4,34 @@
 #
 # License: 3-clause BSD
 #
+from collections import namedtuple
+from itertools import product
+
 from trac.util.html import tag
 from trac.resource import ResourceExistsError
 
+
+# Lightweight read-only representation of a relation. See Relation.select_rows().
+RelationRow = namedtuple('RelationRow', ('id', 'realm', 'source', 'dest', 'type'))
+
+# Maximum number of parameters in a single query. SQLite before 3.32 doesn't
+# allow more than 999.
+MAX_SQL_PARAMS = 999
+
+
+def chunked(values, num_params=0, num_lists=1):
+    """Split a list of values into chunks small enough for an 'IN (...)' clause.
+
+    :param values: list of values
+    :param num_params: number of other parameters of the query
+    :param num_lists: number of value lists of the query which are chunked
+                      with the same size
+    :return a list of lists
+    """
+    size = max(1, (MAX_SQL_PARAMS - num_params) // num_lists)
+    return [values[idx:idx + size] for idx in range(0, len(values), size)]
+
+
 class Relation(object):
 
     realm = 'relation'
@@ -19,7 +44,8 @@ class Relation(object):
         self.env = env
         self.values = {'realm': realm, 'source': src,
                        'dest': dest, 'type': type}
-        self.exists = False
+        self._exists = False
+        self._id = None
         try:
             self.check_fields()  # This ignores the relation_id
         except ValueError:
@@ -30,10 +56,36 @@ class Relation(object):
                 if res:
                     Relation._assign_values(self, *res)
         else:
-            res = list(Relation._fetch_from_db(env, realm, src, dest, type))
-            if res:
-                self.id = res[0][0]
-                self.exists = True
+            # The database is only queried when 'exists' or 'id' is accessed.
+            # When just inserting the relation the lookup isn't necessary.
+            self._exists = None
+
+    def _fetch_id(self):
+        val = self.values
+        self._exists = False
+        for res in Relation._fetch_from_db(self.env, val['realm'], val['source'], val['dest'], val['type']):
+            self._id = res[0]
+            self._exists = True
+
+    @property
+    def exists(self):
+        if self._exists is None:
+            self._fetch_id()
+        return self._exists
+
+    @exists.setter
+    def exists(self, value):
+        self._exists = value
+
+    @property
+    def id(self):
+        if self._exists is None:
+            self._fetch_id()
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
 
     def __repr__(self):
         val = self.values
@@ -66,39 +118,110 @@ class Relation(object):
     @staticmethod
     def _fetch_from_db(env, realm=None, src=None, dest=None, reltype=None):
         if not realm:
-            for res in env.db_query("""SELECT * FROM relation"""):
+            for res in env.db_query("""SELECT id, realm, source, dest, type FROM relation"""):
                 yield res
         else:
-            sql = "SELECT * FROM relation WHERE realm=%s"
+            sql = "SELECT id, realm, source, dest, type FROM relation WHERE realm=%s"
             vals = [realm]
+            multi = []  # list of (column, values) for set-valued filters
             for item in (('source', src), ('dest', dest), ('type', reltype)):
-                if item[1]:
+                if isinstance(item[1], (list, tuple, set, frozenset)):
+                    if not item[1]:
+                        return
+                    multi.append((item[0], sorted(set(str(val) for val in item[1]))))
+                elif item[1]:
                     sql += " AND %s=%%s" % item[0]
                     vals.append(str(item[1]))
 
-            for res in env.db_query(sql, vals):
-                yield res
+            if not multi:
+                for res in env.db_query(sql, vals):
+                    yield res
+                return
+
+            # Split the value lists into chunks so we don't exceed the maximum
+            # number of parameters for a query. Each combination of chunks is
+            # queried separately.
+            for chunks in product(*[chunked(values, len(vals), len(multi)) for col, values in multi]):
+                in_sql = sql
+                in_vals = list(vals)
+                for (col, values), chunk in zip(multi, chunks):
+                    in_sql += " AND %s IN (%s)" % (col, ','.join(['%s'] * len(chunk)))
+                    in_vals.extend(chunk)
+                for res in env.db_query(in_sql, in_vals):
+                    yield res
 
     @staticmethod
     def _fetch_by_id(env, relation_id):
-        for res in env.db_query("SELECT * FROM relation WHERE id=%s", (relation_id,)):
+        for res in env.db_query("SELECT id, realm, source, dest, type FROM relation WHERE id=%s",
+                                (relation_id,)):
             return res
 
     @classmethod
     def select(cls, env, realm=None, src=None, dest=None, reltype=None):
+        """Select relations from the database.
 
+        :param env: Trac Environment
+        :param realm: realm of the relations. If not given all relations are returned
+        :param src: source id or a list/set of source ids
+        :param dest: destination id or a list/set of destination ids
+        :param reltype: relation type or a list/set of relation types
+
+        For lists the relations matching any of the items are returned. Long
+        lists are split into several queries.
+        """
         for rel in Relation._fetch_from_db(env, realm, src, dest, reltype):
             relation = cls(env, realm)
             cls._assign_values(relation, *rel)
             yield relation
 
+    @classmethod
+    def select_by_resource(cls, env, realm, res_id):
+        """Select all relations starting or ending at the given resource.
+
+        :param env: Trac Environment
+        :param realm: realm of the relations
+        :param res_id: id of the resource, e.g. a ticket id
+        :return a tuple (outgoing, incoming). Both are lists of relations sorted
+                by type. For outgoing relations the resource is the source, for
+                incoming relations it is the destination.
+
+        Both directions are fetched with a single query.
+        """
+        res_id = str(res_id)
+        outgoing = []
+        incoming = []
+        for rel in env.db_query("""
+                SELECT id, realm, source, dest, type FROM relation
+                WHERE realm=%s AND (source=%s OR dest=%s)
+                ORDER BY type, id
+                """, (realm, res_id, res_id)):
+            relation = cls(env, realm)
+            cls._assign_values(relation, *rel)
+            if rel[2] == res_id:
+                outgoing.append(relation)
+            else:
+                incoming.append(relation)
+        return outgoing, incoming
+
+    @staticmethod
+    def select_rows(env, realm=None, src=None, dest=None, reltype=None):
+        """Same as select() but returns RelationRow tuples instead of Relation objects.
+
+        Use this when reading lots of relations which are not modified
+        afterwards. It avoids the overhead of creating full objects.
+        """
+        return map(RelationRow._make, Relation._fetch_from_db(env, realm, src, dest, reltype))
+
     def insert(self, when=None):
         self.check_fields()
 
         val = self.values
-        if self.exists:
-            raise ResourceExistsError("Relation '%s', '%s', '%s', '%s' already exists." %
-                                      (val['realm'], val['source'], val['dest'], val['type']))
+        msg = "Relation '%s', '%s', '%s', '%s' already exists." % \
+              (val['realm'], val['source'], val['dest'], val['type'])
+        # Don't query the database if we don't know yet. The unique
+        # constraint of the table takes care of duplicates.
+        if self._exists:
+            raise ResourceExistsError(msg)
         try:
             with self.env.db_transaction as db:
                 cursor = db.cursor()
@@ -110,8 +233,43 @@ class Relation(object):
                 self.exists = True
                 self.id = db.get_last_id(cursor, 'relation', 'id')
         except self.env.db_exc.IntegrityError:
-            raise
-            # raise ValueError("Relations must be unique.")
+            raise ResourceExistsError(msg)
+
+    @staticmethod
+    def insert_many(env, relations):
+        """Insert all the given relations using a single transaction.
+
+        :param env: Trac Environment
+        :param relations: list of Relation objects. When done each relation has
+                          its 'id' set.
+
+        A ResourceExistsError is raised if any relation already exists. Nothing
+        is inserted in that case.
+        """
+        for relation in relations:
+            relation.check_fields()
+
+        keys = [(rel['realm'], str(rel['source']), str(rel['dest']), rel['type'])
+                for rel in relations]
+        with env.db_transaction as db:
+            for max_id, in db("SELECT MAX(id) FROM relation"):
+                break
+            cursor = db.cursor()
+            try:
+                cursor.executemany("""INSERT INTO relation
+                                      (realm, source, dest, type)
+                                      VALUES (%s,%s,%s,%s)
+                                      """, keys)
+            except env.db_exc.IntegrityError:
+                raise ResourceExistsError("At least one of the relations already exists.")
+            # Get the ids of the new relations
+            ids = {}
+            for row in db("SELECT id, realm, source, dest, type FROM relation WHERE id>%s",
+                          (max_id or 0,)):
+                ids[row[1:]] = row[0]
+            for key, relation in zip(keys, relations):
+                relation.id = ids[key]
+                relation.exists = True
 
     @staticmethod
     def delete_relation_by_id(env, rel_id):
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+from collections import defaultdict
+from trac.config import ListOption
+from trac.core import Component, implements
+from trac.util.translation import _, N_
+from trac.web.api import IRequestFilter
+
+from .model import Relation
+from .ticket import TktRelation
+
+
+# Relation columns for the query page. Key: column name,
+# val: (label, relation type, True if the ticket is the relation source)
+RELATION_COLUMNS = {
+    'blocked_by': (N_("Blocked By"), TktRelation.BLOCKING, False),
+    'blocking': (N_("Blocking"), TktRelation.BLOCKING, True),
+    'parent': (N_("Parent"), TktRelation.PARENTCHILD, False),
+    'children': (N_("Children"), TktRelation.PARENTCHILD, True),
+}
+
+
+def open_blockers_sql(db, ticket_column='t.id'):
+    """SQL condition which is true if a ticket is blocked by open tickets.
+
+    :param db: database connection used to create the casts for the backend
+    :param ticket_column: column holding the ticket id in the outer query
+    :return SQL for a WHERE clause. Prepend 'NOT ' to get actionable tickets.
+
+    The condition is an EXISTS subquery so the database stops at the first
+    open blocker. The lookup uses the relation index on (realm, dest, type).
+    """
+    return """EXISTS (SELECT 1 FROM relation r
+                  INNER JOIN ticket b ON b.id=%s
+                WHERE r.realm='ticket' AND r.type='%s' AND r.dest=%s AND b.status!='closed')""" % \
+           (db.cast('r.source', 'int'), TktRelation.BLOCKING, db.cast(ticket_column, 'text'))
+
+
+def open_children_sql(db, ticket_column='t.id'):
+    """SQL condition which is true if a ticket has open child tickets.
+
+    See open_blockers_sql() for the parameters. The lookup uses the unique
+    relation index on (realm, source, dest, type).
+    """
+    return """EXISTS (SELECT 1 FROM relation r
+                  INNER JOIN ticket c ON c.id=%s
+                WHERE r.realm='ticket' AND r.type='%s' AND r.source=%s AND c.status!='closed')""" % \
+           (db.cast('r.dest', 'int'), TktRelation.PARENTCHILD, db.cast(ticket_column, 'text'))
+
+
+def select_tickets(env, has_open_blockers=None, has_open_children=None, status=None):
+    """Select tickets by their open blockers and open children.
+
+    :param env: Trac Environment
+    :param has_open_blockers: True to get tickets blocked by open tickets, False
+                              for tickets without open blockers. None to ignore
+                              blockers.
+    :param has_open_children: the same for open child tickets
+    :param status: optional list of ticket states to select
+    :return a list of ticket ids sorted by id
+
+    The filtering is done by the database. Actionable tickets are selected with
+    select_tickets(env, has_open_blockers=False, status=['new', 'assigned', ...]).
+    """
+    with env.db_query as db:
+        clauses = []
+        args = []
+        if has_open_blockers is not None:
+            clauses.append(('' if has_open_blockers else 'NOT ') + open_blockers_sql(db))
+        if has_open_children is not None:
+            clauses.append(('' if has_open_children else 'NOT ') + open_children_sql(db))
+        if status:
+            clauses.append("t.status IN (%s)" % ','.join(['%s'] * len(status)))
+            args += status
+        sql = "SELECT t.id FROM ticket t"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return [row[0] for row in db(sql + " ORDER BY t.id", args)]
+
+
+class RelationQueryColumns(Component):
+    """Show ticket relations as columns of the custom query page.
+
+    The columns are configured in ''trac.ini'':
+    {{{#!ini
+    [ticket-relations]
+    query_columns = blocked_by, children
+    }}}
+
+    Available columns are {{{blocked_by}}}, {{{blocking}}}, {{{parent}}}
+    and {{{children}}}. The relations of all tickets on a result page are
+    fetched at once.
+
+    Reports may filter by open blockers or open child tickets with
+    {{{EXISTS}}} subqueries. This report lists actionable tickets, that
+    are open tickets without open blockers:
+    {{{#!sql
+    SELECT t.id AS ticket, t.summary, t.status FROM ticket t
+    WHERE t.status != 'closed' AND NOT EXISTS (
+        SELECT 1 FROM relation r INNER JOIN ticket b ON b.id=CAST(r.source AS int)
+        WHERE r.realm='ticket' AND r.type='blocking' AND r.dest=CAST(t.id AS text)
+          AND b.status != 'closed')
+    }}}
+    Replace {{{'blocking'}}} with {{{'parentchild'}}} and swap {{{source}}} and
+    {{{dest}}} to check for open child tickets. The casts work with SQLite and
+    PostgreSQL only. On MySQL use {{{CAST(r.source AS signed)}}} and
+    {{{CAST(t.id AS char)}}}. Plugins may use {{{select_tickets()}}} which
+    creates the casts for the database in use.
+    """
+
+    implements(IRequestFilter)
+
+    query_columns = ListOption('ticket-relations', 'query_columns', default='',
+                               doc="Relation columns added to the results of the custom query page. "
+                                   "Possible values: blocked_by, blocking, parent, children.")
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, metadata=None):
+        if template == 'query.html' and data and 'tickets' in data:
+            columns = [col for col in self.query_columns if col in RELATION_COLUMNS]
+            if columns:
+                self.add_relation_columns(data, columns)
+        return template, data, metadata
+
+    def add_relation_columns(self, data, columns):
+        """Add relation columns to the data of the query page.
+
+        :param data: data dict of 'query.html'
+        :param columns: list of column names from RELATION_COLUMNS
+        """
+        tickets = data['tickets']
+        related = self.get_related_tickets([tkt['id'] for tkt in tickets],
+                                           {RELATION_COLUMNS[col][1] for col in columns})
+        query_href = data['query'].get_href(data['context'].href)
+        for col in columns:
+            label, reltype, is_source = RELATION_COLUMNS[col]
+            # Sorting by relations isn't supported so the header links to the current query
+            data['headers'].append({'name': col, 'label': _(label), 'href': query_href,
+                                    'field': {'name': col, 'type': 'text', 'format': 'wiki'}})
+            for tkt in tickets:
+                ids = related[(tkt['id'], reltype, is_source)]
+                tkt[col] = u', '.join('#%s' % tkt_id for tkt_id in sorted(ids))
+
+    def get_related_tickets(self, tkt_ids, reltypes):
+        """Get the tickets related to the given tickets.
+
+        :param tkt_ids: list of ticket ids
+        :param reltypes: set of relation types
+        :return a dict with key: (ticket id, relation type, True if the ticket is the source),
+                val: set of ids (int) of the tickets at the other end of the relations.
+                The dict is a defaultdict so missing keys give an empty set.
+        """
+        related = defaultdict(set)
+        for rows in (Relation.select_rows(self.env, 'ticket', src=tkt_ids, reltype=reltypes),
+                     Relation.select_rows(self.env, 'ticket', dest=tkt_ids, reltype=reltypes)):
+            for row in rows:
+                related[(int(row.source), row.type, True)].add(int(row.dest))
+                related[(int(row.dest), row.type, False)].add(int(row.source))
+        return related
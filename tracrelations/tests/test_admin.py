@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from trac.admin.api import AdminCommandError
+from trac.test import EnvironmentStub
+from tracrelations.admin import RelationAdminCommands
+from tracrelations.api import RelationSystem
+from tracrelations.model import Relation
+
+from tracrelations.tests.util import revert_schema
+
+
+class TestRelationAdminCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=["trac.*", "tracrelations.*"])
+        self.plugin = RelationAdminCommands(self.env)
+        self.relsys = RelationSystem(self.env)
+        with self.env.db_transaction as db:
+            revert_schema(self.env)
+            self.relsys.upgrade_environment()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.tempdir)
+
+    def _add_relations(self):
+        self.relsys.add_relations([Relation(self.env, 'ticket', '1', '2', 'blocking'),
+                                   Relation(self.env, 'ticket', '2', '3', 'parentchild'),
+                                   Relation(self.env, 'wiki', 'FooPage', 'Bar, "Page"', 'relation')])
+
+    def _relations(self):
+        return sorted(self.env.db_query("SELECT realm, source, dest, type FROM relation"))
+
+    def _export(self, fmt, **kwargs):
+        out = io.StringIO()
+        self.plugin.export_relations(out, fmt=fmt, **kwargs)
+        return out.getvalue()
+
+    def test_export_csv(self):
+        self._add_relations()
+        self.plugin.export_page_size = 2
+        self.assertEqual('realm,source,dest,type\n'
+                         'ticket,1,2,blocking\n'
+                         'ticket,2,3,parentchild\n'
+                         'wiki,FooPage,"Bar, ""Page""",relation\n', self._export('csv'))
+        self.assertEqual('realm,source,dest,type\n'
+                         'ticket,2,3,parentchild\n', self._export('csv', realm='ticket', reltype='parentchild'))
+
+    def test_export_jsonl(self):
+        self._add_relations()
+        self.assertEqual('{"dest": "3", "realm": "ticket", "source": "2", "type": "parentchild"}\n',
+                         self._export('jsonl', reltype='parentchild'))
+
+    def test_export_import(self):
+        self._add_relations()
+        expected = self._relations()
+        for fmt in ('csv', 'jsonl'):
+            data = self._export(fmt)
+            for relation in list(Relation.select(self.env)):
+                self.relsys.delete_relation(relation)
+            self.assertEqual(3, self.plugin.import_relations(io.StringIO(data), fmt, batch_size=2))
+            self.assertEqual(expected, self._relations())
+
+    def test_export_import_file(self):
+        self.relsys.add_relation(Relation(self.env, 'wiki', u'StartSeite', u'Überblick, "Seite"', 'relation'))
+        expected = self._relations()
+        commands = dict((cmd[0], cmd[-1]) for cmd in self.plugin.get_admin_commands())
+        for name in ('relations.csv', 'relations.jsonl'):
+            path = os.path.join(self.tempdir, name)
+            commands['relation export'](path)
+            self.relsys.delete_relation(Relation(self.env, 'wiki', u'StartSeite', u'Überblick, "Seite"', 'relation'))
+            with patch('tracrelations.admin.printout'):
+                commands['relation import'](path)
+            self.assertEqual(expected, self._relations())
+
+    def test_import_resume(self):
+        path = os.path.join(self.tempdir, 'relations.csv')
+        with open(path, 'w') as f:
+            f.write('realm,source,dest,type\n'
+                    'ticket,1,2,parentchild\n'
+                    'ticket,2,3,parentchild\n'
+                    'ticket,3,1,parentchild\n'  # cycle
+                    'ticket,4,5,parentchild\n')
+        commands = dict((cmd[0], cmd[-1]) for cmd in self.plugin.get_admin_commands())
+        with patch('tracrelations.admin.printout'):
+            self.assertRaises(AdminCommandError, commands['relation import'], path, '--batch-size=2')
+        self.assertEqual([('ticket', '1', '2', 'parentchild'),
+                          ('ticket', '2', '3', 'parentchild')], self._relations())
+
+        # Fix the file and run again. The committed rows are skipped.
+        with open(path, 'w') as f:
+            f.write('realm,source,dest,type\n'
+                    'ticket,1,2,parentchild\n'
+                    'ticket,2,3,parentchild\n'
+                    'ticket,1,3,parentchild\n'
+                    'ticket,4,5,parentchild\n')
+        with patch('tracrelations.admin.printout') as printout:
+            commands['relation import'](path, '--batch-size=2')
+        self.assertEqual(['Resuming import after 2 rows.', '2 relations imported.'],
+                         [call[0][0] for call in printout.call_args_list])
+        self.assertEqual(4, len(self._relations()))
+        self.assertEqual([], self.env.db_query("SELECT * FROM system WHERE name LIKE 'relation_import:%'"))
+
+    def test_import_invalid_rows(self):
+        # Empty field
+        self.assertRaises(AdminCommandError, self.plugin.import_relations,
+                          io.StringIO('ticket,1,,parentchild\n'), 'csv')
+        self.assertRaises(AdminCommandError, self.plugin.import_relations,
+                          io.StringIO('{"realm": "ticket", "source": "1", "dest": null, "type": "parentchild"}\n'),
+                          'jsonl')
+        self.assertEqual(1, self.plugin.import_relations(
+            io.StringIO('{"realm": "ticket", "source": 1, "dest": 2, "type": "parentchild"}\n'), 'jsonl'))
+        self.assertEqual([('ticket', '1', '2', 'parentchild')], self._relations())
+
+    def test_import_integrity_error(self):
+        """A relation added concurrently after validation is reported."""
+        self.env.db_transaction("INSERT INTO relation (realm, source, dest, type) "
+                                "VALUES ('ticket', '1', '2', 'parentchild')")
+        with self.assertRaises(AdminCommandError) as cm:
+            self.plugin.import_relations(io.StringIO('ticket,1,2,parentchild\n'), 'csv')
+        self.assertIn('Rows 1 to 1 were not imported', str(cm.exception))
+
+    def test_export_command(self):
+        self._add_relations()
+        path = os.path.join(self.tempdir, 'relations.jsonl')
+        commands = dict((cmd[0], cmd[-1]) for cmd in self.plugin.get_admin_commands())
+        commands['relation export'](path, '--realm=wiki')
+        with open(path) as f:
+            self.assertEqual(1, len(f.readlines()))
+        self.assertRaises(AdminCommandError, commands['relation export'], '--format=xml')
+        self.assertRaises(AdminCommandError, commands['relation export'], '--foo=bar')
+
+
+if __name__ == '__main__':
+    unittest.main()
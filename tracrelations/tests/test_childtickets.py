@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from trac.perm import PermissionCache, PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
+from trac.web.api import RequestDone
+from trac.ticket.model import Ticket
+from tracrelations.api import RelationSystem
+from tracrelations.childtickets import ChildTicketRelations, MoreChildTickets
+from tracrelations.model import Relation
+
+from tracrelations.tests.util import insert_ticket, revert_schema
+
+
+class TestChildTicketTree(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=["trac.*", "tracrelations.*"])
+        self.env.config.set('ticket-custom', 'relationdata', 'text')
+        self.env.config.set('ticket-custom', 'estimate', 'text')
+        self.env.config.set('ticket-custom', 'estimate.value', '0')
+        self.env.config.set('relations-child', 'parent.task.table_headers', 'summary, estimate, time')
+        self.plugin = ChildTicketRelations(self.env)
+        self.relsys = RelationSystem(self.env)
+        with self.env.db_transaction as db:
+            revert_schema(self.env)
+            self.relsys.upgrade_environment()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _insert_ticket(self, summary, **kwargs):
+        return insert_ticket(self.env, summary, type='task', **kwargs).id
+
+    def _add_child(self, parent, child):
+        self.relsys.add_relation(Relation(self.env, 'ticket', parent, child, 'parentchild'))
+
+    def test_load_child_tree(self):
+        root = self._insert_ticket('Root')
+        child1 = self._insert_ticket('Child 1', estimate='5')
+        child2 = self._insert_ticket('Child 2', status='closed')
+        grandchild = self._insert_ticket('Grandchild', description='Some text')
+        self._add_child(root, child2)
+        self._add_child(root, child1)
+        self._add_child(child1, grandchild)
+
+        tree = self.plugin.load_child_tree(root)
+        self.assertEqual([(child1, 1), (grandchild, 2), (child2, 1)],
+                         [(tkt.id, tkt.indent) for tkt in tree])
+        self.assertEqual('Child 1', tree[0]['summary'])
+        self.assertEqual('5', tree[0]['estimate'])
+        self.assertEqual('0', tree[2]['estimate'])  # default of custom field
+        self.assertEqual('closed', tree[2]['status'])
+        self.assertEqual('Some text', tree[1]['description'])
+        ticket = Ticket(self.env, grandchild)
+        self.assertEqual(ticket['time'], tree[1]['time'])
+        self.assertFalse(any(tkt.max_view for tkt in tree))
+
+    def test_load_child_tree_custom_time_field(self):
+        self.env.config.set('ticket-custom', 'due', 'time')
+        self.env.config.set('relations-child', 'parent.task.table_headers', 'summary, due')
+        root = self._insert_ticket('Root')
+        due = datetime(2021, 5, 1, 12, 30, tzinfo=utc)
+        self._add_child(root, self._insert_ticket('Child 1', due=due))
+        self._add_child(root, self._insert_ticket('Child 2'))
+
+        tree = self.plugin.load_child_tree(root)
+        self.assertEqual(due, tree[0]['due'])
+        self.assertEqual('', tree[1]['due'])
+
+    def test_load_child_tree_max_depth(self):
+        self.env.config.set('relations-child', 'max_view_depth', 2)
+        ids = [self._insert_ticket('Ticket %s' % idx) for idx in range(4)]
+        for parent, child in zip(ids, ids[1:]):
+            self._add_child(parent, child)
+
+        tree = self.plugin.load_child_tree(ids[0])
+        self.assertEqual([(ids[1], 1, False), (ids[2], 2, True)],
+                         [(tkt.id, tkt.indent, tkt.max_view) for tkt in tree])
+
+    def test_load_child_tree_several_parents(self):
+        root = self._insert_ticket('Root')
+        child1 = self._insert_ticket('Child 1')
+        child2 = self._insert_ticket('Child 2')
+        shared = self._insert_ticket('Shared')
+        self._add_child(root, child1)
+        self._add_child(root, child2)
+        self._add_child(child1, shared)
+        self._add_child(child2, shared)
+
+        tree = self.plugin.load_child_tree(root)
+        self.assertEqual([(child1, 1), (shared, 2), (child2, 1), (shared, 2)],
+                         [(tkt.id, tkt.indent) for tkt in tree])
+
+    def test_load_child_tree_queries(self):
+        root = self._insert_ticket('Root')
+        for idx in range(20):
+            child = self._insert_ticket('Child %s' % idx)
+            self._add_child(root, child)
+            for idx2 in range(3):
+                self._add_child(child, self._insert_ticket('Grandchild %s' % idx2))
+
+        with patch.object(ChildTicketRelations, '_fetch_ticket_values',
+                          wraps=self.plugin._fetch_ticket_values) as fetch:
+            tree = self.plugin.load_child_tree(root)
+        self.assertEqual(80, len(tree))
+        # Tickets are fetched once per level
+        self.assertEqual(2, fetch.call_count)
+        self.assertEqual(20, len(fetch.call_args_list[0][0][0]))
+        self.assertEqual(60, len(fetch.call_args_list[1][0][0]))
+
+    def _get_children(self, tkt_id, **kwargs):
+        req = MockRequest(self.env, authname='joe', path_info='/ticket/%s/children' % tkt_id,
+                          args=kwargs)
+        self.assertTrue(self.plugin.match_request(req))
+        self.assertRaises(RequestDone, self.plugin.process_request, req)
+        self.assertEqual('200 Ok', req.status_sent[0])
+        return req.response_sent.getvalue().decode('utf-8')
+
+    def test_page_holds_child_count_only(self):
+        root = self._insert_ticket('Root')
+        for idx in range(3):
+            self._add_child(root, self._insert_ticket('Child %s' % idx))
+        req = MockRequest(self.env, authname='joe')
+
+        with patch.object(ChildTicketRelations, 'load_child_tree') as load:
+            html = str(self.plugin.create_childticket_tree_html(req, Ticket(self.env, root)))
+        self.assertFalse(load.called)
+        self.assertIn('(3)', html)
+        self.assertIn('data-href="/trac.cgi/ticket/%s/children"' % root, html)
+        self.assertNotIn('Child 1', html)
+
+    def test_children_endpoint(self):
+        root = self._insert_ticket('Root')
+        child = self._insert_ticket('Child')
+        grandchild = self._insert_ticket('Grandchild')
+        self._add_child(root, child)
+        self._add_child(child, grandchild)
+
+        html = self._get_children(root)
+        self.assertIn('Child', html)
+        self.assertNotIn('Grandchild', html)
+        self.assertIn('/trac.cgi/ticket/%s/children?indent=2' % child, html)
+
+        html = self._get_children(child, indent=2)
+        self.assertIn('Grandchild', html)
+        self.assertIn('margin-left: 3%', html)
+
+        html = self._get_children(root, depth=2)
+        self.assertIn('Grandchild', html)
+        self.assertNotIn('childrel-expand', html)
+
+        self.assertEqual('', self._get_children(grandchild))
+
+    def test_children_endpoint_hidden_ticket(self):
+        """Tickets the user may not view are skipped together with their children."""
+        root = self._insert_ticket('Root')
+        hidden = self._insert_ticket('Hidden')
+        hidden_child = self._insert_ticket('Child of hidden')
+        visible = self._insert_ticket('Visible')
+        visible_child = self._insert_ticket('Child of visible')
+        self._add_child(root, hidden)
+        self._add_child(hidden, hidden_child)
+        self._add_child(root, visible)
+        self._add_child(visible, visible_child)
+
+        orig_has_permission = PermissionCache._has_permission
+
+        def has_permission(perm, action, resource):
+            return resource.id != hidden and orig_has_permission(perm, action, resource)
+
+        with patch.object(PermissionCache, '_has_permission', has_permission):
+            html = self._get_children(root, depth=2)
+        self.assertNotIn('Hidden', html)
+        self.assertNotIn('Child of hidden', html)
+        self.assertIn('Visible', html)
+        self.assertIn('Child of visible', html)
+        # Each top level ticket has its own div
+        self.assertEqual(1, html.count('<div class="childrel-tables">'))
+
+    def test_children_endpoint_max_depth(self):
+        self.env.config.set('relations-child', 'max_view_depth', 2)
+        ids = [self._insert_ticket('Ticket %s' % idx) for idx in range(4)]
+        for parent, child in zip(ids, ids[1:]):
+            self._add_child(parent, child)
+
+        html = self._get_children(ids[1], indent=2)
+        self.assertIn('Ticket 2', html)
+        self.assertNotIn('childrel-expand', html)
+        self.assertIn('Rest of the child ticket tree is hidden', html)
+
+    def test_description_cache(self):
+        root = self._insert_ticket('Root')
+        child = self._insert_ticket('Child', description="'''Bold'''")
+        self._add_child(root, child)
+
+        self.assertIn('<strong>Bold</strong>', self._get_children(root))
+        self.assertEqual({'size': 1, 'max_size': 1000, 'hits': 0, 'misses': 1},
+                         self.plugin.description_cache.stats)
+        self.assertIn('<strong>Bold</strong>', self._get_children(root))
+        self.assertEqual(1, self.plugin.description_cache.stats['hits'])
+
+        # Changing the ticket renders the description again
+        ticket = Ticket(self.env, child)
+        ticket['description'] = "''Italic''"
+        ticket.save_changes('joe', when=ticket['changetime'] + timedelta(seconds=1))
+        html = self._get_children(root)
+        self.assertIn('<em>Italic</em>', html)
+        self.assertNotIn('Bold', html)
+        self.assertEqual(2, self.plugin.description_cache.stats['misses'])
+
+        # Another user doesn't get the cached description
+        req = MockRequest(self.env, authname='jane', path_info='/ticket/%s/children' % root)
+        self.assertTrue(self.plugin.match_request(req))
+        self.assertRaises(RequestDone, self.plugin.process_request, req)
+        self.assertEqual(3, self.plugin.description_cache.stats['misses'])
+
+        # Permission changes
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADMIN')
+        self._get_children(root)
+        self.assertEqual(4, self.plugin.description_cache.stats['misses'])
+
+    def test_description_context(self):
+        """Relative links refer to the child ticket, not to the parent showing it."""
+        parent1 = self._insert_ticket('Parent 1')
+        parent2 = self._insert_ticket('Parent 2')
+        child = self._insert_ticket('Child', description="See comment:1")
+        Ticket(self.env, child).save_changes('joe', 'The comment')
+        self._add_child(parent1, child)
+        self._add_child(parent2, child)
+        for parent in (parent1, parent2):
+            html = self._get_children(parent)
+            self.assertIn('href="/trac.cgi/ticket/%s#comment:1"' % child, html)
+
+    def test_children_pages(self):
+        self.env.config.set('relations-child', 'max_children_per_level', 2)
+        root = self._insert_ticket('Root')
+        children = [self._insert_ticket('Child %s' % idx) for idx in range(5)]
+        for child in reversed(children):
+            self._add_child(root, child)
+        grandchildren = [self._insert_ticket('Grandchild %s' % idx) for idx in range(3)]
+        for grandchild in grandchildren:
+            self._add_child(children[0], grandchild)
+
+        self.assertEqual((children[:2], 3), self.plugin.get_children_page(root))
+        self.assertEqual((children[4:], 0), self.plugin.get_children_page(root, after=children[3]))
+
+        tree = self.plugin.load_child_tree(root, depth=2)
+        self.assertEqual([(children[0], 1), (grandchildren[0], 2), (grandchildren[1], 2),
+                          ('more', children[0], grandchildren[1], 2),
+                          (children[1], 1), ('more', root, children[1], 1)],
+                         [('more', tkt.parent_id, tkt.after, tkt.indent) if isinstance(tkt, MoreChildTickets)
+                          else (tkt.id, tkt.indent) for tkt in tree])
+
+        html = self._get_children(root)
+        self.assertIn('Show 3 more child tickets', html)
+        self.assertIn('/trac.cgi/ticket/%s/children?after=%s&amp;indent=1' % (root, children[1]), html)
+        html = self._get_children(root, after=children[1])
+        self.assertIn('Child 2', html)
+        self.assertIn('Child 3', html)
+        self.assertNotIn('Child 1', html)
+        self.assertNotIn('Child 4', html)
+        self.assertIn('Show 1 more child ticket<', html)
+
+    def test_parent_type_snapshot(self):
+        self.env.config.set('relations-child', 'parent.task.allow_child_tickets', 'true')
+        self.env.config.set('relations-child', 'parent.task.restrict_child_type', 'defect, task')
+        self.env.config.set('relations-child', 'parent.task.table_headers', 'summary, unknown, estimate')
+
+        ptype = self.plugin.get_parent_type('task')
+        self.assertEqual(('task', True, ('summary', 'estimate'), ('defect', 'task'), (), 'defect'), ptype)
+        self.assertIs(ptype, self.plugin.get_parent_type('task'))
+        self.assertEqual(('defect', False, ('summary', 'owner'), (), (), 'defect'),
+                         self.plugin.get_parent_type('defect'))
+        self.assertIn('estimate', self.plugin._get_config_snapshot().tree_fields)
+
+        # A new snapshot is created with the next request when the settings change
+        self.env.config.set('relations-child', 'parent.task.allow_child_tickets', 'false')
+        self.assertIs(ptype, self.plugin.get_parent_type('task'))
+        self.plugin.pre_process_request(MockRequest(self.env), None)
+        self.assertFalse(self.plugin.get_parent_type('task').allow_child_tickets)
+        self.env.config.set('ticket', 'default_type', 'task')
+        self.plugin.pre_process_request(MockRequest(self.env), None)
+        self.assertEqual('task', self.plugin.get_parent_type('defect').default_child_type)
+
+    def _add_rollup_tree(self):
+        self.env.config.set('relations-child', 'rollup_fields', 'estimate')
+        root = self._insert_ticket('Root', estimate='100')
+        child1 = self._insert_ticket('Child 1', estimate='2', status='closed')
+        child2 = self._insert_ticket('Child 2', estimate='1.5')
+        shared = self._insert_ticket('Shared', estimate='4')
+        bad_value = self._insert_ticket('Bad value', estimate='four')
+        self._add_child(root, child1)
+        self._add_child(root, child2)
+        self._add_child(child1, shared)
+        self._add_child(child2, shared)
+        self._add_child(child2, bad_value)
+        return root, child1, child2, shared
+
+    def test_rollup(self):
+        root, child1, child2, shared = self._add_rollup_tree()
+        # The estimate default value '0' is used for the ticket without custom value
+        no_value = self._insert_ticket('No value')
+        self._add_child(child2, no_value)
+        self.env.db_transaction("DELETE FROM ticket_custom WHERE ticket=%s AND name='estimate'", (no_value,))
+
+        self.assertEqual((5, 1, {'estimate': 7.5}), self.plugin.get_rollup(root))
+        self.assertEqual((1, 0, {'estimate': 4}), self.plugin.get_rollup(child1))
+        self.assertEqual((0, 0, {'estimate': 0}), self.plugin.get_rollup(shared))
+        self.assertEqual('<span class="childrel-rollup">1/5 children closed (20%), Estimate: 7.5</span>',
+                         str(self.plugin.render_rollup(root)))
+        self.assertIsNone(self.plugin.render_rollup(shared))
+
+    @patch.object(RelationSystem, 'has_recursive_cte', False)
+    def test_rollup_without_cte(self):
+        self.test_rollup()
+
+    def test_rollup_hidden_ticket(self):
+        """Descendants the user may not view are not part of the rollup."""
+        root, child1, child2, shared = self._add_rollup_tree()
+        orig_has_permission = PermissionCache._has_permission
+
+        def has_permission(perm, action, resource):
+            return resource.id != shared and orig_has_permission(perm, action, resource)
+
+        perm = PermissionCache(self.env, 'joe')
+        with patch.object(PermissionCache, '_has_permission', has_permission):
+            self.assertEqual((3, 1, {'estimate': 3.5}), self.plugin.get_rollup(root, perm))
+            self.assertIsNone(self.plugin.render_rollup(child1, perm=perm))
+        # The cached values are shared by all users
+        self.assertEqual((4, 1, {'estimate': 7.5}), self.plugin.get_rollup(root, PermissionCache(self.env, 'jane')))
+        self.assertEqual(1, self.plugin.rollup_cache.stats['hits'])
+
+    def test_rollups_of_tree(self):
+        """The rollups of all tree nodes are computed together."""
+        root, child1, child2, shared = self._add_rollup_tree()
+        with patch.object(RelationSystem, 'descendants', wraps=self.relsys.descendants) as descendants:
+            html = self._get_children(root, depth=3)
+        self.assertEqual(1, descendants.call_count)
+        self.assertEqual({child1, child2}, set(descendants.call_args[0][1]))
+        self.assertIn('0/1 children closed', html)
+        self.assertIn('0/2 children closed', html)
+
+    def test_rollup_cache(self):
+        root, child1, child2, shared = self._add_rollup_tree()
+        self.assertEqual((4, 1, {'estimate': 7.5}), self.plugin.get_rollup(root))
+        self.assertEqual((4, 1, {'estimate': 7.5}), self.plugin.get_rollup(root))
+        self.assertEqual(1, self.plugin.rollup_cache.stats['hits'])
+
+        # Change of a grandchild
+        ticket = Ticket(self.env, shared)
+        ticket['estimate'] = '10'
+        ticket['status'] = 'closed'
+        ticket.save_changes('joe')
+        self.assertEqual((4, 2, {'estimate': 13.5}), self.plugin.get_rollup(root))
+
+        # Relation changes
+        self._add_child(child1, self._insert_ticket('New', estimate='1'))
+        self.assertEqual((5, 2, {'estimate': 14.5}), self.plugin.get_rollup(root))
+        self.relsys.delete_relation(Relation(self.env, 'ticket', root, child2, 'parentchild'))
+        self.assertEqual((3, 2, {'estimate': 13}), self.plugin.get_rollup(root))
+
+        # Changes of other fields or of tickets without parent keep the cache
+        generation = self.plugin.rollup_generation
+        ticket = Ticket(self.env, shared)
+        ticket['summary'] = 'Changed'
+        ticket.save_changes('joe')
+        ticket = Ticket(self.env, root)
+        ticket['estimate'] = '1'
+        ticket.save_changes('joe')
+        self.assertEqual(generation, self.plugin.rollup_generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,9 @@
 # License: 3-clause BSD
 #
 import unittest
+from trac.db.api import DatabaseManager
 from trac.test import EnvironmentStub
-from tracrelations.api import RelationSystem
+from tracrelations.api import db_version_key, RelationSystem
 from tracrelations.tests.util import revert_schema
 
 class TestEnvironmentUpgrade(unittest.TestCase):
@@ -17,9 +18,55 @@ class TestEnvironmentUpgrade(unittest.TestCase):
         self.plugin = RelationSystem(self.env)
         revert_schema(self.env)
 
+    def tearDown(self):
+        self.env.reset_db()
+
     def test_install_v1(self):
         self.plugin.upgrade_environment()
 
+    def test_install(self):
+        self.assertTrue(self.plugin.environment_needs_upgrade())
+        self.plugin.upgrade_environment()
+        self.assertFalse(self.plugin.environment_needs_upgrade())
+        self.assertEqual(4, DatabaseManager(self.env).get_database_version(db_version_key))
+
+    def test_upgrade_v1(self):
+        with self.env.db_transaction as db:
+            db("""CREATE TABLE relation (
+                  id              serial PRIMARY KEY,
+                  realm           text,
+                  source          text,
+                  dest            text,
+                  type            text,
+                  UNIQUE(realm, source, dest, type)
+                  )""")
+            db.executemany("INSERT INTO relation (realm, source, dest, type) VALUES (%s,%s,%s,%s)",
+                           [('ticket', '1', '2', 'blocking'),
+                            ('ticket', '2', '3', 'parentchild')])
+        dbm = DatabaseManager(self.env)
+        dbm.set_database_version(1, db_version_key)
+
+        self.assertTrue(self.plugin.environment_needs_upgrade())
+        self.plugin.upgrade_environment()
+        self.assertFalse(self.plugin.environment_needs_upgrade())
+
+        rows = self.env.db_query("SELECT id, realm, source, dest, type FROM relation ORDER BY source")
+        self.assertEqual([('ticket', '1', '2', 'blocking'),
+                          ('ticket', '2', '3', 'parentchild')], [row[1:] for row in rows])
+        # The ids were NULL with the version 1 table on SQLite
+        self.assertTrue(all(row[0] for row in rows))
+
+        indexes = [row[0] for row in self.env.db_query(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='relation'")]
+        self.assertIn('relation_realm_dest_type_source_idx', indexes)
+        self.assertIn('relation_realm_type_source_dest_idx', indexes)
+
+        # Version 3
+        self.assertIn('relation_log', DatabaseManager(self.env).get_table_names())
+        self.assertEqual([('0',)], self.env.db_query("SELECT value FROM system WHERE name='relation_log_id'"))
+        # Version 4
+        self.assertIn('relation_closure', DatabaseManager(self.env).get_table_names())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,7 +8,7 @@ import unittest
 from trac.resource import ResourceExistsError
 from trac.test import EnvironmentStub
 from tracrelations.api import RelationSystem
-from tracrelations.model import Relation
+from tracrelations.model import Relation, RelationRow
 
 from tracrelations.tests.util import revert_schema
 
@@ -44,6 +44,28 @@ class TestRelationModel(unittest.TestCase):
         self.assertTrue(rel.exists)
         self.assertEqual(2, rel.id)
 
+    def test_relation_lazy(self):
+        self._add_relations()
+        rel = Relation(self.env, 'ticket', '1', '3', 'rel1')
+        self.assertIsNone(rel._exists)
+        self.assertEqual(2, rel.id)
+        self.assertTrue(rel.exists)
+
+        rel = Relation(self.env, 'ticket', '1', '5', 'rel1')
+        self.assertFalse(rel.exists)
+        self.assertIsNone(rel.id)
+
+    def test_insert_without_lookup(self):
+        self._add_relations()
+        rel = Relation(self.env, 'ticket', '1', '5', 'rel1')
+        rel.insert()
+        self.assertTrue(rel.exists)
+        self.assertEqual(7, rel.id)
+
+        # Duplicates are found by the database
+        rel = Relation(self.env, 'ticket', '1', '5', 'rel1')
+        self.assertRaises(ResourceExistsError, rel.insert)
+
     def test_relation_int(self):
         self._add_relations()
         rel = Relation(self.env, 'ticket', 1, 3, 'rel1')
@@ -82,10 +104,10 @@ class TestRelationModel(unittest.TestCase):
         self.assertTrue(relation.exists)
         self.assertEqual(1, relation.id)
 
-        # Try to insert the same data -> ValueError
+        # Try to insert the same data -> ResourceExistsError
         relation = Relation(self.env, 'ticket')
         fill_data(relation)
-        self.assertRaises(ValueError, relation.insert)
+        self.assertRaises(ResourceExistsError, relation.insert)
         self.assertFalse(relation.exists)
 
         # Try again with altered 'dest'
@@ -93,6 +115,29 @@ class TestRelationModel(unittest.TestCase):
         relation.insert()
         self.assertEqual(2, relation.id)
 
+    def test_insert_many(self):
+        self._add_relations()
+        relations = [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+                     Relation(self.env, 'ticket', '5', '7', 'rel1'),
+                     Relation(self.env, 'wiki', 'BazPage', 'FooPage', 'rel1')]
+        Relation.insert_many(self.env, relations)
+        self.assertEqual([7, 8, 9], [rel.id for rel in relations])
+        self.assertTrue(all(rel.exists for rel in relations))
+        self.assertEqual(9, len(list(Relation.select(self.env))))
+        self.assertEqual(8, Relation(self.env, 'ticket', '5', '7', 'rel1').id)
+
+    def test_insert_many_duplicate(self):
+        self._add_relations()
+        relations = [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+                     Relation(self.env, 'ticket', '1', '2', 'rel1')]
+        self.assertRaises(ResourceExistsError, Relation.insert_many, self.env, relations)
+        # Duplicates in the list itself
+        relations = [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+                     Relation(self.env, 'ticket', '5', '6', 'rel1')]
+        self.assertRaises(ResourceExistsError, Relation.insert_many, self.env, relations)
+        # Nothing was inserted
+        self.assertEqual(6, len(list(Relation.select(self.env))))
+
     def test_select(self):
         self._add_relations()
         # Query all
@@ -113,6 +158,61 @@ class TestRelationModel(unittest.TestCase):
         rels = list(Relation.select(self.env, 'ticket', dest='3'))
         self.assertEqual(1, len(rels))
 
+    def test_select_multi(self):
+        self._add_relations()
+        rels = list(Relation.select(self.env, 'ticket', src=['1', 3]))
+        self.assertEqual(4, len(rels))
+        rels = list(Relation.select(self.env, 'ticket', src={'1', '3'}, dest=('3', '4')))
+        self.assertEqual([(2, '1', '3'), (5, '3', '4'), (6, '1', '4')],
+                         sorted((rel.id, rel['source'], rel['dest']) for rel in rels))
+        rels = list(Relation.select(self.env, 'ticket', src=['1', '3'], reltype=['rel2']))
+        self.assertEqual([5, 6], sorted(rel.id for rel in rels))
+        rels = list(Relation.select(self.env, 'wiki', dest=['BarPage', 'BazPage'], reltype='relation'))
+        self.assertEqual(2, len(rels))
+        # Empty list matches nothing
+        self.assertEqual([], list(Relation.select(self.env, 'ticket', src=[])))
+
+    def test_select_multi_chunked(self):
+        with self.env.db_transaction as db:
+            db.executemany("""INSERT INTO relation (realm, source, dest, type)
+                              VALUES ('ticket', %s, %s, %s)""",
+                           [(str(i), str(i + 1), reltype) for i in range(3000)
+                            for reltype in ('rel1', 'rel2')])
+        # More values than parameters allowed in a single query
+        rows = list(Relation.select_rows(self.env, 'ticket', src=list(range(0, 6000, 2))))
+        self.assertEqual(3000, len(rows))
+        rows = list(Relation.select_rows(self.env, 'ticket', src=list(range(2500)),
+                                         dest=list(range(1, 2000)), reltype=['rel2']))
+        self.assertEqual(1999, len(rows))
+        self.assertEqual(1999, len(set(row.id for row in rows)))
+
+    def test_select_by_resource(self):
+        self._add_relations()
+        outgoing, incoming = Relation.select_by_resource(self.env, 'ticket', '3')
+        self.assertEqual([(5, '3', '4', 'rel2')],
+                         [(rel.id, rel['source'], rel['dest'], rel['type']) for rel in outgoing])
+        self.assertEqual([(2, '1', '3', 'rel1')],
+                         [(rel.id, rel['source'], rel['dest'], rel['type']) for rel in incoming])
+
+        outgoing, incoming = Relation.select_by_resource(self.env, 'ticket', 1)
+        self.assertEqual([1, 2, 6], [rel.id for rel in outgoing])
+        self.assertEqual(['rel1', 'rel1', 'rel2'], [rel['type'] for rel in outgoing])
+        self.assertEqual([], incoming)
+
+        outgoing, incoming = Relation.select_by_resource(self.env, 'wiki', '1')
+        self.assertEqual(([], []), (outgoing, incoming))
+
+    def test_select_rows(self):
+        self._add_relations()
+        rows = list(Relation.select_rows(self.env))
+        self.assertEqual(6, len(rows))
+        self.assertEqual(RelationRow(1, 'ticket', '1', '2', 'rel1'), rows[0])
+
+        rows = list(Relation.select_rows(self.env, 'ticket', src='1', reltype='rel2'))
+        self.assertEqual([(6, 'ticket', '1', '4', 'rel2')], rows)
+        self.assertEqual('4', rows[0].dest)
+        self.assertEqual('rel2', rows[0].type)
+
     def test_save_changes_missing_field(self):
         self._add_relations()
 
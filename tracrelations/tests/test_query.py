@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import random
+import unittest
+from unittest.mock import patch
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.query import Query
+from trac.web.chrome import web_context
+from tracrelations.api import RelationSystem
+from tracrelations.model import MAX_SQL_PARAMS, Relation
+from tracrelations.query import RelationQueryColumns, select_tickets
+
+from tracrelations.tests.util import insert_ticket, revert_schema
+
+
+class TestRelationQueryColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=["trac.*", "tracrelations.*"])
+        self.env.config.set('ticket-custom', 'relationdata', 'text')
+        self.plugin = RelationQueryColumns(self.env)
+        self.relsys = RelationSystem(self.env)
+        with self.env.db_transaction as db:
+            revert_schema(self.env)
+            self.relsys.upgrade_environment()
+        for idx in range(1, 6):
+            insert_ticket(self.env, 'Ticket %s' % idx)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _add_relation(self, src, dest, reltype):
+        self.relsys.add_relation(Relation(self.env, 'ticket', src, dest, reltype))
+
+    def _query_data(self):
+        req = MockRequest(self.env, authname='joe')
+        query = Query.from_string(self.env, 'order=id')
+        data = query.template_data(web_context(req, 'query'), query.execute(req))
+        return self.plugin.post_process_request(req, 'query.html', data)[1]
+
+    def test_relation_columns(self):
+        self.env.config.set('ticket-relations', 'query_columns', 'blocked_by, blocking, unknown, parent, children')
+        self._add_relation(2, 1, 'blocking')
+        self._add_relation(3, 1, 'blocking')
+        self._add_relation(1, 4, 'parentchild')
+        self._add_relation(1, 5, 'parentchild')
+        self._add_relation(1, 2, 'relation')
+
+        data = self._query_data()
+        self.assertEqual(['blocked_by', 'blocking', 'parent', 'children'],
+                         [header['name'] for header in data['headers']][-4:])
+        tickets = {tkt['id']: tkt for tkt in data['tickets']}
+        self.assertEqual(('#2, #3', '', '', '#4, #5'),
+                         tuple(tickets[1][col] for col in ('blocked_by', 'blocking', 'parent', 'children')))
+        self.assertEqual(('', '#1', '', ''),
+                         tuple(tickets[2][col] for col in ('blocked_by', 'blocking', 'parent', 'children')))
+        self.assertEqual('#1', tickets[5]['parent'])
+
+    def test_no_columns(self):
+        headers = [header['name'] for header in self._query_data()['headers']]
+        self.assertNotIn('children', headers)
+
+    def test_get_related_tickets_chunked(self):
+        self._add_relation(1, 4, 'parentchild')
+        self._add_relation(5, 1, 'blocking')
+        tkt_ids = list(range(1, 2 * MAX_SQL_PARAMS))
+        with patch('tracrelations.model.MAX_SQL_PARAMS', 10):
+            related = self.plugin.get_related_tickets(tkt_ids, {'parentchild', 'blocking'})
+        self.assertEqual({4}, related[(1, 'parentchild', True)])
+        self.assertEqual({1}, related[(4, 'parentchild', False)])
+        self.assertEqual({5}, related[(1, 'blocking', False)])
+        self.assertEqual(set(), related[(2, 'blocking', False)])
+
+    def test_select_tickets(self):
+        self.env.db_transaction("UPDATE ticket SET status='closed' WHERE id=5")
+        self._add_relation(2, 1, 'blocking')
+        self._add_relation(5, 3, 'blocking')  # closed blocker
+        self._add_relation(1, 4, 'parentchild')
+        self._add_relation(3, 5, 'parentchild')  # closed child
+        self._add_relation(4, 2, 'relation')
+
+        self.assertEqual([1, 2, 3, 4, 5], select_tickets(self.env))
+        self.assertEqual([1], select_tickets(self.env, has_open_blockers=True))
+        self.assertEqual([2, 3, 4], select_tickets(self.env, has_open_blockers=False,
+                                                   status=['new', 'assigned']))
+        self.assertEqual([1], select_tickets(self.env, has_open_children=True))
+        self.assertEqual([2, 3, 4, 5], select_tickets(self.env, has_open_children=False))
+        self.assertEqual([], select_tickets(self.env, has_open_blockers=True, has_open_children=False))
+
+    def test_select_tickets_large(self):
+        num_tickets = 50000
+        rnd = random.Random(23)
+        statuses = {tkt_id: rnd.choice(('new', 'assigned', 'closed')) for tkt_id in range(1, num_tickets + 1)}
+        relations = set()
+        for reltype in ('blocking', 'parentchild'):
+            while len(relations) < (30000 if reltype == 'blocking' else 60000):
+                src, dest = rnd.randint(1, num_tickets), rnd.randint(1, num_tickets)
+                if src != dest:
+                    relations.add((str(src), str(dest), reltype))
+        with self.env.db_transaction as db:
+            db("DELETE FROM ticket")
+            db.executemany("INSERT INTO ticket (id, summary, status) VALUES (%s,%s,%s)",
+                           [(tkt_id, 'Ticket', status) for tkt_id, status in statuses.items()])
+            db.executemany("INSERT INTO relation (realm, source, dest, type) VALUES ('ticket',%s,%s,%s)",
+                           sorted(relations))
+
+        blocked = {int(dest) for src, dest, reltype in relations
+                   if reltype == 'blocking' and statuses[int(src)] != 'closed'}
+        parents = {int(src) for src, dest, reltype in relations
+                   if reltype == 'parentchild' and statuses[int(dest)] != 'closed'}
+        open_tickets = {tkt_id for tkt_id, status in statuses.items() if status != 'closed'}
+
+        self.assertEqual(sorted(open_tickets - blocked),
+                         select_tickets(self.env, has_open_blockers=False, status=['new', 'assigned']))
+        self.assertEqual(sorted(blocked), select_tickets(self.env, has_open_blockers=True))
+        self.assertEqual(sorted(parents), select_tickets(self.env, has_open_children=True))
+        self.assertEqual(sorted(set(statuses) - parents - blocked),
+                         select_tickets(self.env, has_open_blockers=False, has_open_children=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,13 @@
 #
 # License: 3-clause BSD
 #
+import random
 import unittest
+from unittest.mock import patch
 from trac.resource import ResourceExistsError
 from trac.test import EnvironmentStub
-from tracrelations.api import RelationSystem, ValidationError
+from tracrelations.admin import RelationAdminCommands
+from tracrelations.api import BACKWARD, FORWARD, log_changes, RelationGraph, RelationSystem, ValidationError
 from tracrelations.model import Relation
 
 from tracrelations.tests.util import revert_schema
@@ -63,6 +66,450 @@ class TestRelationSystem(unittest.TestCase):
         relation = Relation(self.env, *rel_data[-1])
         self.assertRaises(ValidationError, self.plugin.add_relation, relation)
 
+    def test_validate_cycle_message(self):
+        for item in (('ticket', '1', '2', 'rel1'),
+                     ('ticket', '2', '3', 'rel1'),
+                     ('ticket', '3', '4', 'rel1')):
+            self.plugin.add_relation(Relation(self.env, *item))
+        relation = Relation(self.env, 'ticket', '4', '2', 'rel1')
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.add_relation(relation)
+        self.assertIn("Cycle detected 4 -> 2 -> 3 -> 4", str(cm.exception))
+
+    def test_validate_cycle_other_type(self):
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        # Different type or realm doesn't close a cycle
+        self.plugin.add_relation(Relation(self.env, 'ticket', '2', '1', 'rel2'))
+        self.plugin.add_relation(Relation(self.env, 'wiki', '2', '1', 'rel1'))
+
+    def test_validate_diamond(self):
+        for item in (('ticket', '1', '2', 'rel1'),
+                     ('ticket', '1', '3', 'rel1'),
+                     ('ticket', '2', '4', 'rel1'),
+                     ('ticket', '3', '4', 'rel1')):
+            self.plugin.add_relation(Relation(self.env, *item))
+        # Reaching a node a second time is no cycle
+        self.plugin.add_relation(Relation(self.env, 'ticket', '4', '5', 'rel1'))
+        relation = Relation(self.env, 'ticket', '5', '1', 'rel1')
+        self.assertRaises(ValidationError, self.plugin.add_relation, relation)
+
+    def _add_layered_dag(self, layers, width):
+        """Each node is linked to every node of the next layer. Node ids
+        are '<layer>.<pos>'."""
+        rows = []
+        for layer in range(layers - 1):
+            for pos in range(width):
+                for nxt in range(width):
+                    rows.append(('%s.%s' % (layer, pos), '%s.%s' % (layer + 1, nxt)))
+        with self.env.db_transaction as db:
+            db.executemany("""INSERT INTO relation (realm, source, dest, type)
+                              VALUES ('ticket', %s, %s, 'rel1')""", rows)
+        RelationGraph(self.env).reset()
+
+    def test_validate_layered_dag(self):
+        self._add_layered_dag(20, 50)
+        # No cycle even though there is a huge number of paths from the first
+        # to the last layer
+        self.plugin.add_relation(Relation(self.env, 'ticket', '0.0', '19.49', 'rel1'))
+
+        relation = Relation(self.env, 'ticket', '19.0', '0.0', 'rel1')
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.add_relation(relation)
+        msg = str(cm.exception)
+        self.assertIn("Cycle detected 19.0 -> 0.0 -> ", msg)
+        self.assertTrue(msg.endswith(" -> 19.0"))
+        # The path has one node per layer
+        self.assertEqual(21, len(msg.split("Cycle detected ")[1].split(' -> ')))
+
+    def test_validate_long_chain(self):
+        with self.env.db_transaction as db:
+            db.executemany("""INSERT INTO relation (realm, source, dest, type)
+                              VALUES ('ticket', %s, %s, 'rel1')""",
+                           [(str(i), str(i + 1)) for i in range(5000)])
+        RelationGraph(self.env).reset()
+        relation = Relation(self.env, 'ticket', '5000', '0', 'rel1')
+        self.assertRaises(ValidationError, self.plugin.add_relation, relation)
+        self.plugin.add_relation(Relation(self.env, 'ticket', '5000', '5001', 'rel1'))
+
+    def test_validate_node_budget(self):
+        self._add_layered_dag(3, 10)
+        self.config.set('relations', 'max_cycle_check_nodes', 5)
+        relation = Relation(self.env, 'ticket', 'x', '0.0', 'rel1')
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.add_relation(relation)
+        self.assertIn("More than 5 related items", str(cm.exception))
+
+        self.config.set('relations', 'max_cycle_check_nodes', 100)
+        self.plugin.add_relation(relation)
+
+    @patch.object(RelationSystem, 'has_recursive_cte', False)
+    def test_validate_node_budget_without_cte(self):
+        self.test_validate_node_budget()
+
+    @patch.object(RelationSystem, 'has_recursive_cte', False)
+    def test_validate_cycle_without_cte(self):
+        for item in (('ticket', '1', '2', 'rel1'),
+                     ('ticket', '1', '3', 'rel1'),
+                     ('ticket', '2', '4', 'rel1'),
+                     ('ticket', '3', '4', 'rel1')):
+            self.plugin.add_relation(Relation(self.env, *item))
+        relation = Relation(self.env, 'ticket', '4', '1', 'rel1')
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.add_relation(relation)
+        self.assertRegex(str(cm.exception), "Cycle detected 4 -> 1 -> [23] -> 4$")
+
+    def test_reachable(self):
+        self._add_relations()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '4', '5', 'rel2'))
+        self.assertTrue(self.plugin.has_recursive_cte)
+        for use_cte in (True, False):
+            with patch.object(RelationSystem, 'has_recursive_cte', use_cte):
+                self.assertEqual({'4', '5'}, self.plugin.reachable('ticket', '1', 'rel2'))
+                self.assertEqual({'4', '5'}, self.plugin.reachable('ticket', 1, 'rel2', FORWARD))
+                self.assertEqual({'1', '3'}, self.plugin.reachable('ticket', '4', 'rel2', BACKWARD))
+                self.assertEqual(set(), self.plugin.reachable('ticket', '5', 'rel2'))
+                self.assertEqual({'BazPage'}, self.plugin.reachable('wiki', 'BarPage', 'relation'))
+
+    def test_descendants(self):
+        self._add_relations()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '4', '5', 'rel2'))
+        expected = {'1': {'4', '5'}, '3': {'4', '5'}, '5': set()}
+        for use_cte in (True, False):
+            with patch.object(RelationSystem, 'has_recursive_cte', use_cte):
+                self.assertEqual(expected, self.plugin.descendants('ticket', [1, '3', '5'], 'rel2'))
+        self._enable_closure('rel2')
+        self.assertEqual(expected, self.plugin.descendants('ticket', [1, '3', '5'], 'rel2'))
+
+    def test_reachable_random_graphs(self):
+        """The results of the recursive query must match the in-memory traversal."""
+        rnd = random.Random(42)
+        graph = RelationGraph(self.env)
+        for run in range(5):
+            edges = set()
+            for _ in range(300):
+                edges.add((str(rnd.randint(1, 80)), str(rnd.randint(1, 80))))
+            with self.env.db_transaction as db:
+                db("DELETE FROM relation")
+                # Cycles are fine here, they are only rejected by add_relation()
+                db.executemany("""INSERT INTO relation (realm, source, dest, type)
+                                  VALUES ('ticket', %s, %s, 'rel1')""", sorted(edges))
+            graph.reset()
+            for start in range(1, 81):
+                for direction in (FORWARD, BACKWARD):
+                    self.assertEqual(graph.reachable('ticket', start, 'rel1', direction),
+                                     self.plugin.reachable('ticket', start, 'rel1', direction))
+
+    def test_add_relations(self):
+        self._add_relations()
+        relations = [Relation(self.env, 'ticket', '2', '5', 'rel1'),
+                     Relation(self.env, 'ticket', '5', '6', 'rel1'),
+                     Relation(self.env, 'ticket', '4', '1', 'rel1')]
+        self.plugin.add_relations(relations)
+        self.assertTrue(all(rel.exists for rel in relations))
+        self.assertEqual(9, len(list(Relation.select(self.env))))
+        self.assertEqual({'2', '3'}, RelationGraph(self.env).get_graph('ticket', 'rel1')['1'])
+        self.assertEqual({'1'}, RelationGraph(self.env).get_graph('ticket', 'rel1')['4'])
+
+    def test_add_relations_validation(self):
+        self._add_relations()
+        batches = (
+            # Same source and destination
+            [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+             Relation(self.env, 'ticket', '7', '7', 'rel1')],
+            # Duplicate in batch
+            [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+             Relation(self.env, 'ticket', '5', '6', 'rel1')],
+            # Cycle within the batch
+            [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+             Relation(self.env, 'ticket', '6', '7', 'rel1'),
+             Relation(self.env, 'ticket', '7', '5', 'rel1')],
+            # Cycle with existing relations
+            [Relation(self.env, 'ticket', '5', '6', 'rel2'),
+             Relation(self.env, 'ticket', '4', '3', 'rel2')],
+        )
+        for batch in batches:
+            self.assertRaises(ValidationError, self.plugin.add_relations, batch)
+
+        # Duplicate of existing relation
+        batch = [Relation(self.env, 'ticket', '5', '6', 'rel1'),
+                 Relation(self.env, 'ticket', '1', '2', 'rel1')]
+        self.assertRaises(ResourceExistsError, self.plugin.add_relations, batch)
+
+        # Nothing was added
+        self.assertEqual(6, len(list(Relation.select(self.env))))
+
+    def test_add_relations_cycle_message(self):
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        batch = [Relation(self.env, 'ticket', '2', '3', 'rel1'),
+                 Relation(self.env, 'ticket', '3', '1', 'rel1')]
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.add_relations(batch)
+        msg = str(cm.exception).split("Cycle detected ")[1]
+        nodes = msg.split(' -> ')
+        self.assertEqual(4, len(nodes))
+        self.assertEqual(nodes[0], nodes[-1])
+        self.assertEqual({'1', '2', '3'}, set(nodes))
+
+    def test_graph(self):
+        graph = RelationGraph(self.env)
+        self._add_relations()
+        self.assertEqual({'1': {'2', '3'}}, graph.get_graph('ticket', 'rel1'))
+        self.assertEqual({'FooPage': {'BarPage'}, 'BarPage': {'BazPage'}},
+                         graph.get_graph('wiki', 'relation'))
+        self.assertEqual({}, graph.get_graph('ticket', 'unknown'))
+
+        relation = Relation(self.env, 'ticket', '1', '3', 'rel1')
+        self.plugin.delete_relation(relation)
+        self.assertEqual({'1': {'2'}}, graph.get_graph('ticket', 'rel1'))
+
+        self.plugin.add_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+        self.assertEqual({'1': {'2'}, '2': {'3'}}, graph.get_graph('ticket', 'rel1'))
+
+    def _no_reload(self, graph):
+        """Context manager failing the test if the graphs are reloaded."""
+        return patch.object(graph, 'reset', side_effect=AssertionError("Graphs reloaded"))
+
+    def test_graph_incremental(self):
+        graph = RelationGraph(self.env)
+        self._add_relations()
+        rel1 = graph.get_graph('ticket', 'rel1')
+        graph.get_graph('ticket', 'rel1', reverse=True)
+
+        # Changes are applied to the loaded graphs
+        with self._no_reload(graph):
+            self.plugin.add_relations([Relation(self.env, 'ticket', '2', '3', 'rel1'),
+                                       Relation(self.env, 'ticket', '3', '5', 'rel1')])
+            self.plugin.delete_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+            self.assertEqual({'1': {'3'}, '2': {'3'}, '3': {'5'}}, graph.get_graph('ticket', 'rel1'))
+            self.assertEqual({'3': {'1', '2'}, '5': {'3'}}, graph.get_graph('ticket', 'rel1', reverse=True))
+        # Graphs given out before aren't modified
+        self.assertEqual({'1': {'2', '3'}}, rel1)
+
+        # Changes of other processes are only visible in the change log
+        with self.env.db_transaction as db:
+            db("INSERT INTO relation (realm, source, dest, type) VALUES ('ticket', '5', '6', 'rel1')")
+            log_changes(self.env, 'add', [Relation(self.env, 'ticket', '5', '6', 'rel1')])
+        with self._no_reload(graph):
+            self.assertEqual({'6'}, graph.get_graph('ticket', 'rel1')['5'])
+
+    def test_graph_last_edge_removed_and_added(self):
+        """A node losing its last edge gets a new one within the same sync."""
+        graph = RelationGraph(self.env)
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        graph.get_graph('ticket', 'rel1')
+        graph.get_graph('ticket', 'rel1', reverse=True)
+
+        with self.env.db_transaction as db:
+            db("DELETE FROM relation WHERE realm='ticket' AND source='1' AND dest='2' AND type='rel1'")
+            log_changes(self.env, 'delete', [Relation(self.env, 'ticket', '1', '2', 'rel1')])
+            added = [Relation(self.env, 'ticket', '1', '3', 'rel1'),
+                     Relation(self.env, 'ticket', '4', '2', 'rel1')]
+            db.executemany("INSERT INTO relation (realm, source, dest, type) VALUES ('ticket', %s, %s, 'rel1')",
+                           [(rel['source'], rel['dest']) for rel in added])
+            log_changes(self.env, 'add', added)
+        with self._no_reload(graph):
+            self.assertEqual({'1': {'3'}, '4': {'2'}}, graph.get_graph('ticket', 'rel1'))
+            self.assertEqual({'3': {'1'}, '2': {'4'}}, graph.get_graph('ticket', 'rel1', reverse=True))
+
+    def test_graph_iteration_while_syncing(self):
+        graph = RelationGraph(self.env)
+        self._add_relations()
+        for node in graph.get_graph('ticket', 'rel1')['1']:
+            self.plugin.add_relation(Relation(self.env, 'ticket', '1', '1%s' % node, 'rel1'))
+            graph.get_graph('ticket', 'rel1')
+        self.assertEqual({'2', '3', '12', '13'}, graph.get_graph('ticket', 'rel1')['1'])
+
+    def test_graph_truncated_log(self):
+        graph = RelationGraph(self.env)
+        self._add_relations()
+        rel1 = graph.get_graph('ticket', 'rel1')
+        with self._no_reload(graph):
+            self.plugin.add_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+            rel1 = graph.get_graph('ticket', 'rel1')
+        with self.env.db_transaction as db:
+            db("DELETE FROM relation_log")
+        self.plugin.add_relation(Relation(self.env, 'ticket', '3', '4', 'rel1'))
+        # Reloaded
+        self.assertIsNot(rel1, graph.get_graph('ticket', 'rel1'))
+        self.assertEqual({'1': {'2', '3'}, '2': {'3'}, '3': {'4'}}, graph.get_graph('ticket', 'rel1'))
+
+    def test_graph_cache_flushed(self):
+        """The change log ids don't depend on the disposable 'cache' table."""
+        graph = RelationGraph(self.env)
+        self._add_relations()
+        graph.get_graph('ticket', 'rel1')
+        self.env.db_transaction("DELETE FROM cache")
+        with self._no_reload(graph):
+            self.plugin.add_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+            self.assertEqual({'3'}, graph.get_graph('ticket', 'rel1')['2'])
+        self.assertEqual([(7,)], self.env.db_query("SELECT MAX(id) FROM relation_log"))
+
+    @patch('tracrelations.api.MAX_INCREMENTAL_CHANGES', 2)
+    def test_graph_too_many_changes(self):
+        graph = RelationGraph(self.env)
+        graph.get_graph('ticket', 'rel1')
+        with self._no_reload(graph):
+            self.plugin.add_relations([Relation(self.env, 'ticket', '1', '2', 'rel1'),
+                                       Relation(self.env, 'ticket', '2', '3', 'rel1')])
+            rel1 = graph.get_graph('ticket', 'rel1')
+        self.plugin.add_relations([Relation(self.env, 'ticket', '3', '4', 'rel1'),
+                                   Relation(self.env, 'ticket', '4', '5', 'rel1'),
+                                   Relation(self.env, 'ticket', '5', '6', 'rel1')])
+        self.assertIsNot(rel1, graph.get_graph('ticket', 'rel1'))
+        self.assertEqual(5, len(graph.get_graph('ticket', 'rel1')))
+
+    def test_change_log(self):
+        self._add_relations()
+        self.plugin.delete_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        rows = self.env.db_query("SELECT id, action, realm, source, dest, type FROM relation_log ORDER BY id")
+        self.assertEqual(7, len(rows))
+        self.assertEqual(list(range(1, 8)), [row[0] for row in rows])
+        self.assertEqual((1, 'add', 'ticket', '1', '2', 'rel1'), rows[0])
+        self.assertEqual((7, 'delete', 'ticket', '1', '2', 'rel1'), rows[-1])
+
+    @patch('tracrelations.api.CHANGE_LOG_SIZE', 4)
+    def test_change_log_size(self):
+        self._add_relations()
+        rows = self.env.db_query("SELECT id FROM relation_log ORDER BY id")
+        self.assertEqual([3, 4, 5, 6], [row[0] for row in rows])
+
+    def _closure_rows(self):
+        return sorted(self.env.db_query("""
+            SELECT realm, type, ancestor, descendant, depth FROM relation_closure"""))
+
+    def _enable_closure(self, reltypes='rel1'):
+        self.config.set('relations', 'closure_types', reltypes)
+        return self.plugin.rebuild_closure()
+
+    def test_closure_rebuild(self):
+        self._add_relations()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '3', '5', 'rel1'))
+        self.assertEqual(set(), self.plugin.get_closure_types())
+        self.assertEqual(4, self._enable_closure())
+        self.assertEqual({'rel1'}, self.plugin.get_closure_types())
+        self.assertEqual([('ticket', 'rel1', '1', '2', 1),
+                          ('ticket', 'rel1', '1', '3', 1),
+                          ('ticket', 'rel1', '1', '5', 2),
+                          ('ticket', 'rel1', '3', '5', 1)], self._closure_rows())
+
+        # Types removed from the option are dropped by the next rebuild
+        rows = self._closure_rows()
+        self.config.set('relations', 'closure_types', 'rel2')
+        self.assertEqual(set(), self.plugin.get_closure_types())
+        self.assertEqual({'2', '3', '5'}, self.plugin.reachable('ticket', '1', 'rel1'))
+        self.assertEqual(rows, self._closure_rows())
+        self.plugin.rebuild_closure()
+        self.assertEqual({'rel2'}, self.plugin.get_closure_types())
+        self.assertEqual(['rel2'], sorted({row[1] for row in self._closure_rows()}))
+
+    @patch('tracrelations.model.MAX_SQL_PARAMS', 1)
+    def test_closure_rebuild_chunked(self):
+        self._add_relations()
+        self.assertEqual(4, self._enable_closure('rel1, rel2, rel3'))
+        self.assertEqual(['rel1', 'rel2'], sorted({row[1] for row in self._closure_rows()}))
+
+    def test_closure_option_removed(self):
+        """Types removed from the option are still maintained until a rebuild."""
+        self._enable_closure()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        self.config.set('relations', 'closure_types', '')
+        self.plugin.add_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+        self.config.set('relations', 'closure_types', 'rel1')
+        rows = self._closure_rows()
+        self.plugin.rebuild_closure()
+        self.assertEqual(rows, self._closure_rows())
+
+    def test_closure_add_existing_pairs(self):
+        """Pairs already in the table are not inserted again."""
+        self._enable_closure()
+        for src, dest in (('1', '2'), ('2', '3'), ('1', '4'), ('4', '3')):
+            self.plugin.add_relation(Relation(self.env, 'ticket', src, dest, 'rel1'))
+        # Adds (1, 3) directly, which already exists with depth 2
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '3', 'rel1'))
+        self.assertIn(('ticket', 'rel1', '1', '3', 1), self._closure_rows())
+
+    def test_closure_maintenance(self):
+        """Adding and deleting relations must give the same table as a rebuild."""
+        self._enable_closure('rel1, rel2')
+        rnd = random.Random(42)
+        edges = []
+        for _ in range(150):
+            src, dest = rnd.sample(range(1, 30), 2)
+            # Edges from lower to higher numbers never create a cycle
+            relation = Relation(self.env, 'ticket', str(min(src, dest)), str(max(src, dest)),
+                                rnd.choice(('rel1', 'rel2')))
+            if not relation.exists:
+                if rnd.random() < 0.2:
+                    self.plugin.add_relations([relation])
+                else:
+                    self.plugin.add_relation(relation)
+                edges.append(relation)
+            if edges and rnd.random() < 0.3:
+                self.plugin.delete_relation(edges.pop(rnd.randrange(len(edges))))
+        rows = self._closure_rows()
+        self.assertTrue(rows)
+        self.plugin.rebuild_closure()
+        self.assertEqual(self._closure_rows(), rows)
+
+    def test_closure_diamond_delete(self):
+        self._enable_closure()
+        for src, dest in (('1', '2'), ('1', '3'), ('2', '4'), ('3', '4'), ('4', '5')):
+            self.plugin.add_relation(Relation(self.env, 'ticket', src, dest, 'rel1'))
+        self.plugin.delete_relation(Relation(self.env, 'ticket', '2', '4', 'rel1'))
+        self.assertEqual({'2', '3', '4', '5'}, self.plugin.reachable('ticket', '1', 'rel1'))
+        self.assertEqual(set(), self.plugin.reachable('ticket', '2', 'rel1'))
+        self.plugin.delete_relation(Relation(self.env, 'ticket', '1', '3', 'rel1'))
+        self.assertEqual({'2'}, self.plugin.reachable('ticket', '1', 'rel1'))
+        self.assertEqual({'3', '4'}, self.plugin.reachable('ticket', '5', 'rel1', BACKWARD))
+
+    def _insert_rows(self, rows):
+        with self.env.db_transaction as db:
+            db.executemany("""INSERT INTO relation (realm, source, dest, type)
+                              VALUES ('ticket', %s, %s, 'rel1')""", rows)
+        RelationGraph(self.env).reset()
+
+    def test_closure_rebuild_cycle(self):
+        self._enable_closure()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        rows = self._closure_rows()
+        self._insert_rows([('2', '1'), ('2', '3')])
+        with self.assertRaises(ValidationError) as cm:
+            self.plugin.rebuild_closure()
+        self.assertIn("relation type 'rel1'", str(cm.exception))
+        self.assertEqual(rows, self._closure_rows())
+
+    def test_closure_delete_cycle(self):
+        """Deleting a relation terminates if the relations contain a cycle."""
+        self._enable_closure()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '1', '2', 'rel1'))
+        self.plugin.add_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+        # The closure table doesn't know of this relation
+        self._insert_rows([('2', '1')])
+        self.plugin.delete_relation(Relation(self.env, 'ticket', '2', '3', 'rel1'))
+        self.assertEqual([('ticket', 'rel1', '1', '2', 1)], self._closure_rows())
+
+    def test_closure_admin_command(self):
+        self._add_relations()
+        self.config.set('relations', 'closure_types', 'rel1')
+        admin = RelationAdminCommands(self.env)
+        rebuild = next(cmd for cmd in admin.get_admin_commands() if cmd[0] == 'relation rebuild-closure')
+        with patch('tracrelations.admin.printout') as printout:
+            rebuild[-1]()
+        self.assertIn('rel1', printout.call_args[0][0])
+        self.assertEqual({'2', '3'}, self.plugin.reachable('ticket', '1', 'rel1'))
+        self.assertEqual(2, len(self._closure_rows()))
+
+    def test_closure_cycle_check(self):
+        self._add_relations()
+        self._enable_closure()
+        self.plugin.add_relation(Relation(self.env, 'ticket', '3', '5', 'rel1'))
+        with patch.object(RelationSystem, 'has_recursive_cte', False):
+            with patch.object(RelationGraph, 'get_graph') as get_graph:
+                self.plugin.add_relation(Relation(self.env, 'ticket', '2', '5', 'rel1'))
+            self.assertFalse(get_graph.called)
+            self.assertRaises(ValidationError, self.plugin.add_relation,
+                              Relation(self.env, 'ticket', '5', '1', 'rel1'))
+
     def test_duplicate(self):
         self._add_relations()
         rel_data = ('ticket', '1', '2', 'rel1')
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import json
+import unittest
+from unittest.mock import patch
+from trac.cache import CacheManager
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.api import TicketFieldList, TicketSystem
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+from tracrelations.api import RelationSystem
+from tracrelations.model import Relation
+from tracrelations.ticket import TicketRelations
+
+from tracrelations.tests.util import insert_ticket, revert_schema
+
+
+class TestTicketRelations(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=["trac.*", "tracrelations.*"])
+        self.env.config.set('ticket-custom', 'relationdata', 'text')
+        self.plugin = TicketRelations(self.env)
+        self.relsys = RelationSystem(self.env)
+        with self.env.db_transaction as db:
+            revert_schema(self.env)
+            self.relsys.upgrade_environment()
+        self.tickets = [insert_ticket(self.env, 'Ticket %s' % idx) for idx in range(1, 5)]
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _add_relation(self, src, dest, reltype):
+        self.relsys.add_relation(Relation(self.env, 'ticket', src, dest, reltype))
+
+    def test_validate_closed_ticket(self):
+        req = MockRequest(self.env, authname='joe')
+        insert_ticket(self.env, 'Closed', status='closed')  # #5
+        self._add_relation(2, 1, 'blocking')
+        self._add_relation(3, 1, 'blocking')
+        self._add_relation(5, 1, 'blocking')
+        self._add_relation(1, 4, 'parentchild')
+        self._add_relation(1, 5, 'parentchild')
+        self._add_relation(1, 3, 'relation')
+
+        ticket = self.tickets[0]
+        ticket['status'] = 'closed'
+        msgs = [msg for field, msg in self.plugin.validate_ticket(req, ticket)]
+        self.assertEqual(["This ticket is blocked. It can't be resolved while these tickets "
+                          "are still open: #2, #3",
+                          "This ticket is a parent. It can't be resolved while these child tickets "
+                          "are still open: #4"], msgs)
+
+        for tkt in self.tickets[1:]:
+            tkt['status'] = 'closed'
+            tkt.save_changes('joe')
+        self.assertEqual([], list(self.plugin.validate_ticket(req, ticket)))
+
+        # Only a closed ticket is checked
+        ticket = Ticket(self.env, 5)
+        ticket['status'] = 'reopened'
+        self.assertEqual([], list(self.plugin.validate_ticket(req, ticket)))
+
+    def test_relations_box_cache(self):
+        req = MockRequest(self.env, authname='joe')
+        ticket = self.tickets[0]
+        cache = self.plugin.box_cache
+
+        wiki, html, have_links = self.plugin.render_relations_box(req, ticket)
+        self.assertFalse(have_links)
+        self.plugin.render_relations_box(req, ticket)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        # Adding a relation changes the generation
+        self._add_relation(1, 2, 'blocking')
+        wiki, html, have_links = self.plugin.render_relations_box(req, ticket)
+        self.assertTrue(have_links)
+        self.assertIn('Ticket 2', str(html))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+        # Other users have their own entries
+        self.plugin.render_relations_box(MockRequest(self.env, authname='jane'), ticket)
+        self.assertEqual((1, 3), (cache.hits, cache.misses))
+        self.plugin.render_relations_box(req, ticket)
+        self.assertEqual((2, 3), (cache.hits, cache.misses))
+
+        # Permission changes
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADMIN')
+        self.plugin.render_relations_box(req, ticket)
+        self.assertEqual((2, 4), (cache.hits, cache.misses))
+
+    def test_relations_box_cache_flushed(self):
+        """Entries created before the 'cache' table was flushed are not used."""
+        req = MockRequest(self.env, authname='joe')
+        ticket = self.tickets[0]
+        self.plugin.render_relations_box(req, ticket)
+
+        self.env.db_transaction("DELETE FROM cache")
+        cache_mgr = CacheManager(self.env)
+        cache_mgr._cache.clear()
+        cache_mgr.reset_metadata()
+        self._add_relation(1, 2, 'blocking')
+        wiki, html, have_links = self.plugin.render_relations_box(req, ticket)
+        self.assertTrue(have_links)
+        self.assertEqual((0, 2), (self.plugin.box_cache.hits, self.plugin.box_cache.misses))
+
+    def test_relations_box_linked_ticket_changed(self):
+        req = MockRequest(self.env, authname='joe')
+        self._add_relation(1, 2, 'blocking')
+        self.plugin.render_relations_box(req, self.tickets[0])
+
+        # Changes to fields not shown in ticket links don't matter
+        ticket = Ticket(self.env, 2)
+        ticket['keywords'] = 'foo'
+        ticket.save_changes('joe')
+        self.plugin.render_relations_box(req, self.tickets[0])
+        self.assertEqual((1, 1), (self.plugin.box_cache.hits, self.plugin.box_cache.misses))
+
+        ticket['summary'] = 'Changed summary'
+        ticket.save_changes('joe')
+        wiki, html, have_links = self.plugin.render_relations_box(req, self.tickets[0])
+        self.assertEqual((1, 2), (self.plugin.box_cache.hits, self.plugin.box_cache.misses))
+        self.assertIn('Changed summary', str(html))
+
+    def _relationdata_rows(self, tkt_id):
+        return self.env.db_query("""
+            SELECT 'custom', value FROM ticket_custom WHERE ticket=%s AND name='relationdata'
+            UNION ALL
+            SELECT 'change', newvalue FROM ticket_change WHERE ticket=%s AND field='relationdata'
+            """, (tkt_id, tkt_id))
+
+    def test_relationdata_not_stored(self):
+        ticket = insert_ticket(self.env, 'Duplicate', relationdata='1')
+        self.assertEqual([], self._relationdata_rows(ticket.id))
+
+        ticket['status'] = 'closed'
+        ticket['resolution'] = 'duplicate'
+        ticket['relationdata'] = '#2'
+        ticket.save_changes('joe')
+        self.assertEqual([], self._relationdata_rows(ticket.id))
+        self.assertEqual([('ticket', str(ticket.id), '2', 'duplicate')],
+                         [(rel['realm'], rel['source'], rel['dest'], rel['type'])
+                          for rel in Relation.select(self.env, 'ticket', src=ticket.id)])
+
+    def test_ticket_save_without_relationdata(self):
+        ticket = self.tickets[0]
+        # Marker row to check if the plugin deletes anything
+        self.env.db_transaction("INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, 'relationdata', 'marker')",
+                                (ticket.id,))
+        ticket['summary'] = 'Changed'
+        ticket.save_changes('joe')
+        self.assertEqual([('custom', 'marker')], self._relationdata_rows(ticket.id))
+
+    def _get_relations_json(self, tkt_id, etag=None, authname='joe'):
+        req = MockRequest(self.env, authname=authname, path_info='/ticket/%s/relations' % tkt_id,
+                          args={'format': 'json'})
+        if etag:
+            req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertTrue(self.plugin.match_request(req))
+        self.assertRaises(RequestDone, self.plugin.process_request, req)
+        return req
+
+    def test_relations_json(self):
+        self._add_relation(1, 2, 'blocking')
+        self._add_relation(3, 1, 'parentchild')
+
+        req = self._get_relations_json(1)
+        self.assertEqual('200 Ok', req.status_sent[0])
+        self.assertEqual('application/json; charset=utf-8', req.headers_sent['Content-Type'])
+        data = json.loads(req.response_sent.getvalue().decode('utf-8'))
+        self.assertEqual(1, data['ticket'])
+        self.assertEqual([['1', '2', 'blocking'], ['3', '1', 'parentchild']],
+                         [rel[1:] for rel in data['relations']])
+        self.assertEqual({'2': ['Ticket 2', 'new'], '3': ['Ticket 3', 'new']}, data['tickets'])
+
+    def test_relations_json_etag(self):
+        self._add_relation(1, 2, 'blocking')
+        etag = self._get_relations_json(1).headers_sent['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('304 Not Modified', req.status_sent[0])
+        self.assertEqual(b'', req.response_sent.getvalue())
+        # The ETag is the same in other processes
+        cache_mgr = CacheManager(self.env)
+        cache_mgr._cache.clear()
+        cache_mgr.reset_metadata()
+        self.assertEqual(etag, self._get_relations_json(1).headers_sent['ETag'])
+        # Other users get another ETag
+        self.assertNotEqual(etag, self._get_relations_json(1, authname='jane').headers_sent['ETag'])
+
+        # Changes of linked tickets
+        ticket = Ticket(self.env, 2)
+        ticket['summary'] = 'Changed summary'
+        ticket.save_changes('joe')
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('200 Ok', req.status_sent[0])
+        self.assertNotEqual(etag, req.headers_sent['ETag'])
+
+        # Relation changes
+        etag = req.headers_sent['ETag']
+        self._add_relation(1, 4, 'relation')
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('200 Ok', req.status_sent[0])
+
+        # Changes of the ticket itself
+        etag = req.headers_sent['ETag']
+        ticket = Ticket(self.env, 1)
+        ticket['summary'] = 'Changed summary'
+        ticket.save_changes('joe')
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('200 Ok', req.status_sent[0])
+
+        # Permission changes
+        etag = req.headers_sent['ETag']
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADMIN')
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('200 Ok', req.status_sent[0])
+
+    def test_relations_json_etag_cache_flushed(self):
+        """ETags are not used again after the 'cache' table was flushed."""
+        self._add_relation(1, 2, 'blocking')
+        etag = self._get_relations_json(1).headers_sent['ETag']
+        generation = self.plugin.relations_generation
+
+        self.env.db_transaction("DELETE FROM cache")
+        cache_mgr = CacheManager(self.env)
+        cache_mgr._cache.clear()
+        cache_mgr.reset_metadata()
+        self.assertEqual(generation, self.plugin.relations_generation)
+        self.relsys.delete_relation(Relation(self.env, 'ticket', '1', '2', 'blocking'))
+        self.assertGreater(self.plugin.relations_generation, generation)
+        req = self._get_relations_json(1, etag)
+        self.assertEqual('200 Ok', req.status_sent[0])
+
+    def test_relations_json_not_modified_is_cheap(self):
+        self._add_relation(1, 2, 'blocking')
+        etag = self._get_relations_json(1).headers_sent['ETag']
+        with patch('tracrelations.ticket.Ticket') as ticket_cls:
+            req = self._get_relations_json(1, etag)
+        self.assertEqual('304 Not Modified', req.status_sent[0])
+        self.assertFalse(ticket_cls.called)
+
+    def _ticket_page_fields(self, tkt_id):
+        req = MockRequest(self.env, authname='joe')
+        ticket = Ticket(self.env, tkt_id)
+        data = {'ticket': ticket, 'fields': TicketFieldList(TicketSystem(self.env).get_ticket_fields())}
+        self.plugin.post_process_request(req, 'ticket.html', data)
+        return data['fields'].by_name('relations')
+
+    def test_async_box(self):
+        self._add_relation(1, 2, 'blocking')
+        self.assertIn('#2', str(self._ticket_page_fields(1)['rendered']))
+
+        self.env.config.set('ticket-relations', 'async_box', True)
+        with patch.object(TicketRelations, 'create_relations_wiki') as create_wiki:
+            rendered = str(self._ticket_page_fields(1)['rendered'])
+        self.assertFalse(create_wiki.called)
+        self.assertIn('id="tktrel-box"', rendered)
+        self.assertIn('data-href="/trac.cgi/ticket/1/relations?format=box"', rendered)
+        self.assertIn('data-fallback-href="/trac.cgi/ticket/1/relations"', rendered)
+
+        req = MockRequest(self.env, authname='joe', path_info='/ticket/1/relations',
+                          args={'format': 'box'})
+        self.assertTrue(self.plugin.match_request(req))
+        self.assertRaises(RequestDone, self.plugin.process_request, req)
+        self.assertIn('#2', req.response_sent.getvalue().decode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import unittest
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub
+from tracrelations.util import get_counter, increment_counter, LRUCache, permission_fingerprint
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        # 'b' is the least recently used item now
+        cache.set('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1}, cache.stats)
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual('x', cache.get('a', 'x'))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(0, len(cache))
+
+
+class TestCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_increment(self):
+        self.assertEqual(0, get_counter(self.env, 'test_counter'))
+        self.assertEqual(1, increment_counter(self.env, 'test_counter'))
+        self.assertEqual(2, increment_counter(self.env, 'test_counter'))
+        self.assertEqual(2, get_counter(self.env, 'test_counter'))
+        self.assertEqual(0, get_counter(self.env, 'other_counter'))
+
+    def test_cache_flushed(self):
+        """The counter doesn't start again when the 'cache' table is flushed."""
+        increment_counter(self.env, 'test_counter')
+        self.env.db_transaction("DELETE FROM cache")
+        self.assertEqual(2, increment_counter(self.env, 'test_counter'))
+
+
+class TestPermissionFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_permission_changes(self):
+        fingerprint = permission_fingerprint(self.env, 'joe')
+        self.assertEqual(fingerprint, permission_fingerprint(self.env, 'joe'))
+        self.assertEqual(fingerprint, permission_fingerprint(self.env, 'jane'))
+
+        PermissionSystem(self.env).grant_permission('joe', 'TICKET_ADMIN')
+        self.assertNotEqual(fingerprint, permission_fingerprint(self.env, 'joe'))
+        self.assertEqual(fingerprint, permission_fingerprint(self.env, 'jane'))
+
+
+if __name__ == '__main__':
+    unittest.main()
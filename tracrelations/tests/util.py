@@ -4,9 +4,28 @@
 #
 # License: 3-clause BSD
 #
+from trac.ticket.model import Ticket
+
+
+def insert_ticket(env, summary, **kwargs):
+    """Insert a new ticket reported by 'joe'.
+
+    :param summary: the ticket summary
+    :param kwargs: more ticket fields
+    :return the Ticket object
+    """
+    ticket = Ticket(env)
+    ticket['summary'] = summary
+    ticket['reporter'] = 'joe'
+    ticket['status'] = 'new'
+    for name, value in kwargs.items():
+        ticket[name] = value
+    ticket.insert()
+    return ticket
+
 
 def revert_schema(env):
     with env.db_transaction as db:
-        for table in ('relation',):
+        for table in ('relation', 'relation_log', 'relation_closure'):
             db("DROP TABLE IF EXISTS %s" % db.quote(table))
-        db("DELETE FROM system WHERE name='relation_version'")
+        db("DELETE FROM system WHERE name IN ('relation_version', 'relation_closure_types', 'relation_log_id')")
@@ -4,8 +4,12 @@
 #
 # License: 3-clause BSD
 #
+import hashlib
+import json
 import re
 from pkg_resources import resource_filename
+from trac.cache import cached
+from trac.config import BoolOption, IntOption
 from trac.core import Component, implements
 from trac.perm import PermissionError
 from trac.resource import get_resource_url, ResourceExistsError, ResourceNotFound
@@ -14,14 +18,15 @@ from trac.ticket.model import Ticket
 from trac.util.html import tag
 from trac.util.text import to_unicode
 from trac.util.translation import _
-from trac.web.api import IRequestFilter, IRequestHandler
+from trac.web.api import IRequestFilter, IRequestHandler, RequestDone
 from trac.web.chrome import add_notice, add_script, add_script_data, add_stylesheet, add_warning, Chrome,\
     ITemplateProvider, web_context
 from trac.wiki.formatter import format_to_html, format_to_oneliner
 
-from .api import RelationSystem, ValidationError
+from .api import IRelationChangeListener, RelationSystem, ValidationError
 from .jtransform import JTransformer
-from .model import Relation
+from .model import chunked, Relation
+from .util import get_counter, increment_counter, LRUCache, permission_fingerprint
 
 try:
     dict.iteritems
@@ -36,6 +41,12 @@ else:
 
 RELDATA_FIELD = 'relationdata'  # ticket custom field name for relation data handling
 
+# Ticket fields used when rendering a ticket link
+LINK_FIELDS = ('summary', 'status', 'type', 'resolution')
+
+# Row in the Trac 'system' table counting the changes of ticket relations
+RELATIONS_COUNTER_KEY = 'relation_ticket_generation'
+
 
 class TktRelation(Relation):
     """Subclass for tickets with special rendering of relations"""
@@ -67,7 +78,6 @@ class TktRelation(Relation):
         if not req:
             return ''
 
-        ctxt = web_context(req)
         reltype = self.values['type']
 
         typelbl = self.relations.get(reltype, (reltype, reltype))[reverse]
@@ -84,7 +94,7 @@ class TktRelation(Relation):
         if render_format == 'wiki':
             return wiki
         else:
-            label = format_to_oneliner(self.env, ctxt, wiki)
+            label = format_to_oneliner(self.env, web_context(req), wiki)
             return tag.span(label, class_="relation")
 
 
@@ -118,10 +128,36 @@ class TicketRelations(Component):
     relationdata = text
     }}}
     """
-    implements(ITicketChangeListener, ITicketManipulator, ITemplateProvider, IRequestFilter, IRequestHandler)
+    implements(IRelationChangeListener, ITicketChangeListener, ITicketManipulator, ITemplateProvider,
+               IRequestFilter, IRequestHandler)
 
     realm = TicketSystem.realm
 
+    box_cache_size = IntOption('ticket-relations', 'box_cache_size', default=1000,
+                               doc="Number of rendered relation boxes kept in memory by each process. "
+                                   "Set to 0 to disable the cache.")
+
+    async_box = BoolOption('ticket-relations', 'async_box', default=False,
+                           doc="Load the relations shown in the ticket property box after the "
+                               "ticket page was displayed.")
+
+    def __init__(self):
+        self.box_cache = LRUCache(self.box_cache_size)
+
+    @cached
+    def relations_generation(self):
+        """Generation of the ticket relations. This changes in all processes when a
+        ticket relation is added or deleted or when a linked ticket is changed.
+
+        The value is a counter in the 'system' table so it is the same in all
+        processes and is never used twice. See _relations_changed().
+        """
+        return get_counter(self.env, RELATIONS_COUNTER_KEY)
+
+    def _relations_changed(self):
+        increment_counter(self.env, RELATIONS_COUNTER_KEY)
+        del self.relations_generation
+
     # ITicketManipulator methods
 
     def prepare_ticket(self, req, ticket, fields, actions):
@@ -136,22 +172,22 @@ class TicketRelations(Component):
         detected. `field` can be `None` to indicate an overall problem with the
         ticket. Therefore, a return value of `[]` means everything is OK."""
 
-        if ticket['status'] == 'closed':
-            # Check for ticket blocking.
-            block_msg = _("This ticket is blocked. It can't be resolved while ticket #{blocktkt} is still open.")
-            rels = Relation.select(self.env, realm=self.realm, dest=ticket.id, reltype='blocking')
-            for rel in rels:
-                tkt = Ticket(self.env, rel['source'])
-                if tkt['status'] != 'closed':
-                    yield None, block_msg.format(blocktkt=rel['source'])
-
-            # Check parent child relationship. Ypu only can close a parent when the child(ren) is(are) closed.
-            child_msg = _("This ticket is a parent. It can't be resolved while ticket #{childtkt} is still open.")
-            rels = Relation.select(self.env, realm=self.realm, src=ticket.id, reltype='parentchild')
-            for rel in rels:
-                tkt = Ticket(self.env, rel['dest'])
-                if tkt['status'] != 'closed':
-                    yield None, child_msg.format(childtkt=rel['dest'])
+        if ticket['status'] == 'closed' and ticket.exists:
+            # You can't close a ticket which is blocked by open tickets. You only can close a
+            # parent when the child(ren) is(are) closed. All open tickets are found with one query.
+            blocking = []
+            children = []
+            for reltype, tkt_id in self._open_blockers_and_children(ticket.id):
+                if reltype == TktRelation.BLOCKING:
+                    blocking.append('#%s' % tkt_id)
+                else:
+                    children.append('#%s' % tkt_id)
+            if blocking:
+                yield None, _("This ticket is blocked. It can't be resolved while these tickets "
+                              "are still open: %(tickets)s", tickets=', '.join(blocking))
+            if children:
+                yield None, _("This ticket is a parent. It can't be resolved while these child tickets "
+                              "are still open: %(tickets)s", tickets=', '.join(children))
 
         if ticket['resolution'] == 'duplicate':
             tkt_id = ticket['relationdata'].strip('# ')
@@ -160,6 +196,26 @@ class TicketRelations(Component):
             except ResourceNotFound:
                 yield None, _("Ticket %(id)s does not exist.", id=tkt_id)
 
+    def _open_blockers_and_children(self, tkt_id):
+        """Get the open tickets blocking the given ticket and the open child tickets.
+
+        :return list of (relation type, ticket id) tuples ordered by type and id
+        """
+        tkt_id = str(tkt_id)
+        with self.env.db_query as db:
+            return db("""
+                SELECT r.type, t.id FROM relation r
+                  INNER JOIN ticket t ON t.id=%s
+                WHERE r.realm=%%s AND r.type=%%s AND r.dest=%%s AND t.status!='closed'
+                UNION ALL
+                SELECT r.type, t.id FROM relation r
+                  INNER JOIN ticket t ON t.id=%s
+                WHERE r.realm=%%s AND r.type=%%s AND r.source=%%s AND t.status!='closed'
+                ORDER BY 1, 2
+                """ % (db.cast('r.source', 'int'), db.cast('r.dest', 'int')),
+                (self.realm, TktRelation.BLOCKING, tkt_id,
+                 self.realm, TktRelation.PARENTCHILD, tkt_id))
+
     def validate_comment(self, req, comment):
         """Validate ticket comment when appending or editing.
 
@@ -184,20 +240,29 @@ class TicketRelations(Component):
                                dest=tkt_id, type=TktRelation.DUPLICATE)
                 RelationSystem(self.env).add_relation(rel)
 
+        if any(name in old_values for name in LINK_FIELDS) and self._has_relations(ticket.id):
+            # Ticket links in the relations box of other tickets show these fields
+            self._relations_changed()
+
         # Remove changes regarding the hidden 'relationdata' field. Otherwise we get
         # change messages in the history or when previewing some ticket changes.
-        with self.env.db_transaction as db:
-            db("DELETE FROM ticket_change WHERE ticket=%s AND field=%s", (ticket.id, 'relationdata'))
-            db("DELETE FROM ticket_custom WHERE ticket=%s AND name=%s", (ticket.id, 'relationdata'))
+        # Trac only writes the field when its value changed. The value is removed
+        # after each save so there is nothing to do for most changes.
+        if RELDATA_FIELD in old_values:
+            with self.env.db_transaction as db:
+                db("DELETE FROM ticket_change WHERE ticket=%s AND field=%s", (ticket.id, RELDATA_FIELD))
+                db("DELETE FROM ticket_custom WHERE ticket=%s AND name=%s", (ticket.id, RELDATA_FIELD))
 
     def ticket_created(self, ticket):
         """Called when a ticket is created."""
         # Remove relationdata from database.
-        with self.env.db_transaction as db:
-            db("DELETE FROM ticket_custom WHERE ticket=%s AND name=%s", (ticket.id, 'relationdata'))
+        if ticket[RELDATA_FIELD]:
+            with self.env.db_transaction as db:
+                db("DELETE FROM ticket_custom WHERE ticket=%s AND name=%s", (ticket.id, RELDATA_FIELD))
 
     def ticket_deleted(self, ticket):
-        pass
+        if self._has_relations(ticket.id):
+            self._relations_changed()
 
     def ticket_comment_modified(self, ticket, cdate, author, comment, old_comment):
         """Called when a ticket comment is modified."""
@@ -210,6 +275,31 @@ class TicketRelations(Component):
         containing the ticket change of the fields that have changed."""
         pass
 
+    # IRelationChangeListener methods
+
+    def relation_added(self, relation):
+        """Called when a relation was added"""
+        if relation['realm'] == self.realm:
+            self._relations_changed()
+
+    def relations_added(self, relations):
+        """Called with a list of relations added at once"""
+        if any(rel['realm'] == self.realm for rel in relations):
+            self._relations_changed()
+
+    def relation_deleted(self, relation):
+        """Called when a relation was deleted"""
+        if relation['realm'] == self.realm:
+            self._relations_changed()
+
+    def _has_relations(self, tkt_id):
+        tkt_id = str(tkt_id)
+        for row in self.env.db_query("""
+                SELECT 1 FROM relation WHERE realm=%s AND (source=%s OR dest=%s) LIMIT 1
+                """, (self.realm, tkt_id, tkt_id)):
+            return True
+        return False
+
     def create_manage_relations_dialog(self):
         tmpl = u"""<div id="manage-rel-dialog" title="Manage Relations" style="display: none">
         <div id="m-r-body"></div>
@@ -262,11 +352,10 @@ class TicketRelations(Component):
         }}}"""
 
         data = {'req': req}
-        is_start = sorted(TktRelation.select(self.env, 'ticket', src=ticket.id), key=lambda k: k['type'])
+        is_start, is_end = TktRelation.select_by_resource(self.env, 'ticket', ticket.id)
         links = [rel.render(data) for rel in is_start]
 
         # Reverse links
-        is_end = sorted(TktRelation.select(self.env, 'ticket', dest=ticket.id), key=lambda k: k['type'])
         for rel in is_end:
             rel['render_reverse'] = True
         rev_links = [rel.render(data) for rel in is_end]
@@ -279,6 +368,30 @@ class TicketRelations(Component):
                              aleft, '[[BR]]'.join(rev_links))
         return wiki, any((is_end, is_start))
 
+    def render_relations_box(self, req, ticket):
+        """Render the relations of a ticket for the ticket property box.
+
+        :param req: the current Request object
+        :param ticket: the currently displayed ticket. A Trac Ticket object
+        :return wikitext, html, have_relations. See create_relations_wiki().
+                'html' is the rendered wiki text.
+
+        The result is cached. The cache key holds the relations generation, the
+        locale, the user and a fingerprint of the user permissions because the
+        rendered ticket links depend on the permissions. The generation is a
+        counter which never decreases so a key is never used again for other
+        relations.
+        """
+        key = (self.relations_generation, ticket.id, str(req.locale), req.authname,
+               permission_fingerprint(self.env, req.authname))
+        box = self.box_cache.get(key)
+        if box is None:
+            wiki, have_links = self.create_relations_wiki(req, ticket)
+            html = format_to_html(self.env, web_context(req, ticket.resource), wiki)
+            box = wiki, html, have_links
+            self.box_cache.set(key, box)
+        return box
+
     # IRequestFilter methods
 
     def pre_process_request(self, req, handler):
@@ -293,12 +406,22 @@ class TicketRelations(Component):
                     have_links = False
                     if 'fields' in data:
                         # Create a temporary field for display only
-                        tkt.values['relations'], have_links = self.create_relations_wiki(req, tkt)  # Activates field
+                        if self.async_box and tkt.exists:
+                            # Only a placeholder. The relations are loaded by ticket_relations.js
+                            tkt.values['relations'] = _("Loading relations...")  # Activates field
+                            rendered = tag.div(tkt['relations'], id="tktrel-box",
+                                               **{'data-href': req.href.ticket(tkt.id, 'relations', format='box'),
+                                                  'data-fallback-href': req.href.ticket(tkt.id, 'relations')})
+                            have_links = self._has_relations(tkt.id)
+                        else:
+                            tkt.values['relations'], rendered, have_links = \
+                                self.render_relations_box(req, tkt)  # Activates field
                         data['fields'].append({
                             'name': 'relations',
                             'label': 'Relations',
                             'type': 'textarea',  # Full row
-                            'format': 'wiki'
+                            'format': 'wiki',
+                            'rendered': rendered
                         })
 
                     filter_lst = []
@@ -363,6 +486,9 @@ class TicketRelations(Component):
 
         if 'TICKET_VIEW' not in req.perm(self.realm, tkt_id):
             raise PermissionError(_("You don't have permission to view this tickets relations."))
+        if req.method == 'GET' and req.args.get('format') == 'json':
+            # Answered without loading the ticket so a '304 Not Modified' is cheap
+            self._send_relations_json(req, int(tkt_id))
         tkt = Ticket(self.env, tkt_id)  # This raises an exception if tkt_id is invalid
 
         # this is set if we use the JQuery dialog for managing relations
@@ -401,6 +527,11 @@ class TicketRelations(Component):
             else:
                 req.redirect(req.href(req.path_info))
 
+        if req.args.get('format') == 'box':
+            # Content of the relations field in the ticket property box
+            wiki, html, have_links = self.render_relations_box(req, tkt)
+            req.send(to_unicode(html).encode('utf-8'), 'text/html')
+
         # Prepare data for select control
         rel_options = []
         aright = TktRelation.arrow_right
@@ -409,12 +540,10 @@ class TicketRelations(Component):
             rel_options.append((key, val[0] + u" " + aright))
             rel_options.append(('!' + key, aleft + u" " + val[1]))
 
-        is_end = sorted(TktRelation.select(self.env, 'ticket', dest=tkt.id), key=lambda k: k['type'])
+        is_start, is_end = TktRelation.select_by_resource(self.env, 'ticket', tkt.id)
         for rel in is_end:
             rel['render_reverse'] = True
 
-        is_start = sorted(TktRelation.select(self.env, 'ticket', src=tkt.id), key=lambda k: k['type'])
-
         data = {'ticket': tkt,
                 'ticket_url': get_resource_url(self.env, tkt.resource, req.href),
                 'fragment': is_fragment,
@@ -428,6 +557,61 @@ class TicketRelations(Component):
         else:
             return 'manage_ticket_relations.html', data, {'domain': 'ticketrelations'}
 
+    def _send_relations_json(self, req, tkt_id):
+        """Send the relations of a ticket as JSON.
+
+        The response is an object with these members:
+
+        * 'ticket': the ticket id
+        * 'relations': list of [id, source, dest, type] for all relations of the ticket
+        * 'tickets': object with key: ticket id, val: [summary, status] for each linked
+          ticket the user may view
+
+        The strong ETag is created from the relations generation (which changes
+        with the linked tickets, too), the permissions of the user, the ticket with
+        its last change time and the user. A matching 'If-None-Match' header
+        gets a '304 Not Modified'.
+        """
+        for changetime, in self.env.db_query("SELECT changetime FROM ticket WHERE id=%s", (tkt_id,)):
+            break
+        else:
+            raise ResourceNotFound(_("Ticket %(id)s does not exist.", id=tkt_id), _("Invalid ticket id"))
+        etag = '"%s"' % hashlib.sha1(u'{0}:{1}:{2}:{3}:{4}'.format(self.relations_generation,
+                                                                  permission_fingerprint(self.env, req.authname),
+                                                                  tkt_id, changetime, req.authname)
+                                     .encode('utf-8')).hexdigest()
+        if_none_match = req.get_header('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              etag in [tag_.strip() for tag_ in if_none_match.split(',')]):
+            req.send_response(304)
+            req.send_header('ETag', etag)
+            req.end_headers()
+            raise RequestDone
+
+        outgoing, incoming = Relation.select_by_resource(self.env, self.realm, tkt_id)
+        relations = [(rel.id, rel['source'], rel['dest'], rel['type']) for rel in outgoing + incoming]
+        linked = sorted({int(rel_end) for rel in relations for rel_end in rel[1:3]} - {tkt_id})
+        tickets = {}
+        with self.env.db_query as db:
+            for chunk in chunked(linked):
+                for linked_id, summary, status in db("""
+                        SELECT id, summary, status FROM ticket WHERE id IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk):
+                    if 'TICKET_VIEW' in req.perm(self.realm, linked_id):
+                        tickets[str(linked_id)] = [summary, status]
+
+        content = json.dumps({'ticket': tkt_id, 'relations': relations, 'tickets': tickets},
+                             separators=(',', ':')).encode('utf-8')
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/json; charset=utf-8')
+        req.send_header('Content-Length', len(content))
+        req.send_header('ETag', etag)
+        # The response depends on the user
+        req.send_header('Cache-Control', 'private, no-cache')
+        req.end_headers()
+        req.write(content)
+        raise RequestDone
+
     # ITemplateProvider methods
 
     def get_templates_dirs(self):
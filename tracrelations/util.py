@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Cinc
+#
+# License: 3-clause BSD
+#
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from trac.perm import PermissionSystem
+
+
+class LRUCache(object):
+    """A bounded mapping discarding the least recently used items.
+
+    The cache counts hits and misses of get() calls. It is safe to use
+    from several threads.
+    """
+
+    def __init__(self, size):
+        self.size = max(0, size)
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Mark as most recently used
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            if self.size:
+                self._items[key] = value
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    @property
+    def stats(self):
+        """Return a dict with the current number of items, hits and misses."""
+        return {'size': len(self._items), 'max_size': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def get_counter(env, name):
+    """Return the value of a counter kept in the Trac 'system' table.
+
+    The value is the same in all processes. As opposed to the generations
+    of the 'cache' table, which may be flushed at any time, it never
+    decreases so it can be used in cache keys and ETags.
+
+    :param env: Trac Environment
+    :param name: the name of the row in the 'system' table
+    :return the counter value or 0 if it wasn't incremented yet
+    """
+    for value, in env.db_query("SELECT value FROM system WHERE name=%s", (name,)):
+        return int(value)
+    return 0
+
+
+def increment_counter(env, name):
+    """Increment a counter kept in the Trac 'system' table, see get_counter().
+
+    The row is locked until the transaction ends so concurrent increments
+    don't get lost.
+
+    :return the new counter value
+    """
+    with env.db_transaction as db:
+        # Lock the row before reading it
+        db("UPDATE system SET value=value WHERE name=%s", (name,))
+        for value, in db("SELECT value FROM system WHERE name=%s", (name,)):
+            value = int(value) + 1
+            db("UPDATE system SET value=%s WHERE name=%s", (str(value), name))
+            break
+        else:
+            value = 1
+            db("INSERT INTO system (name, value) VALUES (%s, %s)", (name, str(value)))
+    return value
+
+
+def permission_fingerprint(env, username):
+    """Return a hash of the permissions of the given user.
+
+    Use it in cache keys and ETags of content depending on the permissions
+    so granting or revoking a permission invalidates them.
+    """
+    perms = sorted(PermissionSystem(env).get_user_permissions(username))
+    return hashlib.sha1(u','.join(perms).encode('utf-8')).hexdigest()